@@ -0,0 +1,133 @@
+import threading
+import numpy as np
+
+'''
+Columnar bndbox store.
+Detection results are kept in one float32 Nx4 bbox array and one score
+array, with a path -> (offset, count) index, instead of a dict of lists of
+dicts. Padding, clipping and squaring are applied to many boxes at once
+with `padded_boxes`.
+
+'''
+
+
+def padded_boxes(bboxes, padding, width, height):
+    '''
+    Apply padding to normalized bboxes, clip them to the image and square them.
+
+    Arguments:
+    ------------
+        bboxes: np.ndarray
+            Nx4 [X1, Y1, X2, Y2] in decimal ratio by image shape.
+        padding: tuple
+            (left, top, right, bottom) in ratio of the bbox size.
+        width, height: int or np.ndarray
+            Image shape, or one shape per bbox.
+    ------------
+    Returns an Nx4 int array of [x1, y1, x2, y2] in pixels.
+
+    '''
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    size = np.stack(np.broadcast_arrays(width, height, width, height), axis=-1).astype(np.float64)
+    box_w = bboxes[:, 2] - bboxes[:, 0]
+    box_h = bboxes[:, 3] - bboxes[:, 1]
+    pad = np.asarray(padding, dtype=np.float64) * np.stack([box_w, box_h, box_w, box_h], axis=1)
+    b = np.clip(np.trunc((bboxes + pad) * size), 0, size)
+    cx = np.trunc((b[:, 2] + b[:, 0]) / 2)
+    cy = np.trunc((b[:, 3] + b[:, 1]) / 2)
+    s = np.trunc(np.minimum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1]) / 2)
+    return np.stack([cx - s, cy - s, cx + s, cy + s], axis=1).astype(np.int64)
+
+
+def padded_box(bbox, padding, width, height):
+    # Single bbox version of `padded_boxes`, returns [x1, y1, x2, y2].
+    return padded_boxes(bbox, padding, width, height)[0].tolist()
+
+
+class BoxStore:
+    '''
+    Store initializations.
+    '''
+
+    def __init__(self, capacity=1024):
+        self.bboxes = np.empty((capacity, 4), dtype=np.float32)
+        self.scores = np.empty((capacity,), dtype=np.float32)   # NaN if no score.
+        self.index = dict()   # {path: (offset, count)}
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, n):
+        # Caller holds the lock.
+        if self.size + n <= len(self.scores): return
+        capacity = max(len(self.scores) * 2, self.size + n)
+        bboxes = np.empty((capacity, 4), dtype=np.float32)
+        scores = np.empty((capacity,), dtype=np.float32)
+        bboxes[:self.size] = self.bboxes[:self.size]
+        scores[:self.size] = self.scores[:self.size]
+        self.bboxes = bboxes
+        self.scores = scores
+
+
+    '''
+    Store functions.
+    '''
+
+    def add(self, path, boxes):
+        '''
+        Arguments:
+        ------------
+            path: str
+                Image path or frame key.
+            boxes: list
+                [{"score": "CONFIDENCE (OPTIONAL)", "bbox": [X1, Y1, X2, Y2]}, ...]
+        ------------
+
+        '''
+        n = len(boxes)
+        with self._lock:
+            self._reserve(n)
+            if n > 0:
+                self.bboxes[self.size:self.size+n] = [box["bbox"] for box in boxes]
+                self.scores[self.size:self.size+n] = [box.get("score", np.nan) for box in boxes]
+            self.index[path] = (self.size, n)
+            self.size += n
+
+    def feed(self, bndboxes, paths=None):
+        # Add results of paths not stored yet, returns the number of paths added.
+        # `bndboxes` is a dict or a ResultStore, looked up for `paths` (default: all of its paths).
+        added = 0
+        for path in (bndboxes if paths is None else paths):
+            if path in self.index: continue
+            boxes = bndboxes.get(path)
+            if boxes:
+                self.add(path, boxes)
+                added += 1
+        return added
+
+    def get(self, path):
+        offset, count = self.index[path]
+        return self.bboxes[offset:offset+count]
+
+    def get_scores(self, path):
+        offset, count = self.index[path]
+        return self.scores[offset:offset+count]
+
+    def padded(self, path, padding, width, height):
+        return padded_boxes(self.get(path), padding, width, height)
+
+    def items(self):
+        for path, (offset, count) in list(self.index.items()):
+            yield path, self.bboxes[offset:offset+count]
+
+    def to_dict(self, path):
+        return [{"score": float(score), "bbox": bbox.tolist()} if not np.isnan(score) else {"bbox": bbox.tolist()}
+                for bbox, score in zip(self.get(path), self.get_scores(path))]
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def nbytes(self):
+        return self.bboxes.nbytes + self.scores.nbytes
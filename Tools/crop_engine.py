@@ -0,0 +1,166 @@
+import os
+import cv2
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Tools.video_source import KeyframeIndex
+from Tools.box_store import padded_boxes
+
+'''
+Batch crop engine for "Crop all bndboxes".
+Takes the bndbox table (a `BoxStore`) and the padding ratios, then
+decodes, crops and encodes every image on a thread pool (OpenCV releases
+the GIL while decoding and encoding). It does not touch any interactive
+Crop_Tool state. Progress is reported in path order.
+
+For videos, `run_video` sorts the requested frames and decodes the video
+once, front to back, cropping each needed frame as it passes by. Frames
+in between are grabbed without being retrieved, and with a saved
+keyframe index long gaps are skipped by seeking forward to a keyframe.
+
+With a `CropManifest`, images already exported with the same source
+mtime, padding and bboxes are skipped, and every finished image is
+recorded once its crops are on disk (`saved`, the sink's `on_saved`), so
+an interrupted export resumes where it stopped.
+
+'''
+
+
+def output_path(path, i):
+    # "<dir>/Output/<name without .jpg/.png>-<i>.jpg"
+    output_dir = os.path.join(os.path.split(path)[0], "Output")
+    return os.path.join(output_dir, os.path.split(path)[-1].replace(".jpg", "")
+                        .replace(".png", "")+"-"+str(i)+".jpg")
+
+
+def imwrite(path, img):
+    if not cv2.imwrite(path, img): raise IOError("Cannot write " + path)
+
+
+class CropEngine:
+    '''
+    Engine initializations.
+    '''
+
+    def __init__(self, padding=(0., 0., 0., 0.), workers=None, read=None, write=None,
+                 progress=None, stop=None, manifest=None, saved=None):
+        self.padding = padding
+        self.workers = workers or os.cpu_count() or 1
+        self.read = read if read is not None else cv2.imread
+        self.write = write if write is not None else imwrite
+        self.progress = progress
+        self.stop = stop
+        self.manifest = manifest
+        self.saved = saved   # saved(paths, callback), None if `write` is durable on return.
+        self.skipped = 0    # Images already in the manifest.
+        self.done = 0       # Images processed.
+        self.written = 0    # Crops written.
+        self.failed = 0     # Images failed.
+
+    def crop_one(self, path, boxes, img=None):
+        # Returns the number of crops written for one image.
+        if img is None: img = self.read(path)
+        height, width = img.shape[:2]
+        n = 0
+        for i, (x1, y1, x2, y2) in enumerate(padded_boxes(boxes, self.padding, width, height).tolist()):
+            out = output_path(path, i)
+            os.makedirs(os.path.dirname(out), exist_ok=True)
+            self.write(out, img[y1:y2, x1:x2])
+            n += 1
+        return n
+
+    def record(self, path, mtime, boxes, n):
+        # Adds the image to the manifest once its `n` crops are saved.
+        if self.manifest is None: return
+        record = lambda: self.manifest.record(path, mtime, self.padding, boxes)
+        if self.saved is None: record()
+        else: self.saved([output_path(path, i) for i in range(n)], record)
+
+    def _crop_one_safe(self, path, boxes, img=None):
+        try: return self.crop_one(path, boxes, img), None
+        except Exception as e: return 0, e
+
+
+    '''
+    Engine RUN function.
+    '''
+
+    @staticmethod
+    def _mtime(path):
+        try: return os.stat(path).st_mtime
+        except OSError: return None
+
+    def _pending(self, items, mtime):
+        # Drop the images the manifest already has, `items` are (path, boxes, ...).
+        if self.manifest is None: return items
+        pending = [item for item in items if not self.manifest.is_done(item[0], mtime(item[0]), self.padding, item[1])]
+        self.skipped = len(items) - len(pending)
+        return pending
+
+    def run(self, bndboxes):
+        items = [(path, boxes) for path, boxes in bndboxes.items() if len(boxes) > 0]
+        items = self._pending(items, self._mtime)
+        total = len(items)
+        window = self.workers * 4   # Bound the images in flight.
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = deque()
+            for path, boxes in items:
+                if self.stop is not None and self.stop(): break
+                futures.append((pool.submit(self._crop_one_safe, path, boxes), path, boxes, self._mtime(path)))
+                # Collect in submission order, so progress is reported in path order.
+                if len(futures) >= window: self._collect(futures.popleft(), total)
+            while futures: self._collect(futures.popleft(), total)
+        return self.written
+
+    @staticmethod
+    def _unreadable(path):
+        return 0, IOError("Cannot read frame " + path)
+
+    def run_video(self, bndboxes, video_path, frame_of):
+        '''
+        Arguments:
+        ------------
+            bndboxes: BoxStore
+                Same as `run`, keyed by frame key.
+            video_path: str
+                The video to decode.
+            frame_of: function
+                Maps a frame key to its frame number.
+        ------------
+
+        '''
+        mtime = self._mtime(video_path)
+        items = [(path, boxes, frame_of(path)) for path, boxes in bndboxes.items() if len(boxes) > 0]
+        items = sorted(self._pending(items, lambda path: mtime), key=lambda item: item[2])
+        total = len(items)
+        window = self.workers * 4
+        keyframes = KeyframeIndex.load(video_path)
+        cap = cv2.VideoCapture(video_path)
+        pos = 0   # Index of the frame the decoder returns next.
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = deque()
+                for path, boxes, frame in items:
+                    if self.stop is not None and self.stop(): break
+                    if keyframes is not None and keyframes.preceding(frame) > pos:
+                        pos = keyframes.preceding(frame)
+                        cap.set(cv2.CAP_PROP_POS_FRAMES, pos)
+                    while pos < frame and cap.grab(): pos += 1
+                    ok, img = cap.read() if pos == frame else (False, None)
+                    if ok:
+                        pos += 1
+                        futures.append((pool.submit(self._crop_one_safe, path, boxes, img), path, boxes, mtime))
+                    else:
+                        futures.append((pool.submit(self._unreadable, path), path, boxes, mtime))
+                    if len(futures) >= window: self._collect(futures.popleft(), total)
+                while futures: self._collect(futures.popleft(), total)
+        finally: cap.release()
+        return self.written
+
+    def _collect(self, item, total):
+        future, path, boxes, mtime = item
+        n, e = future.result()
+        self.done += 1
+        self.written += n
+        if e is not None: self.failed += 1; print(e)
+        else: self.record(path, mtime, boxes, n)
+        if self.progress is not None: self.progress(self.done, total)
@@ -0,0 +1,90 @@
+import os
+import json
+import zlib
+import threading
+import numpy as np
+
+'''
+Output manifest for "Crop all bndboxes".
+Every image whose crops were all written is appended to a JSON Lines file
+as {"path", "mtime", "padding", "output", "boxes", "crc"}, where `output` is
+the sink settings (mode, npy size, tar quality), `boxes` is the number
+of crops (box indices 0..boxes-1) and `crc` a checksum of the bbox values,
+taken at a fixed precision so the float32 `BoxStore` copy and the float64
+JSON copy of the same detections match.
+A rerun skips images whose source mtime, padding, output and bboxes are unchanged,
+so interrupted exports resume where they stopped. The latest line of a
+path wins; `compact` rewrites the file with one line per path.
+
+'''
+
+
+def boxes_crc(boxes):
+    # Through float32 as BoxStore keeps them, then in 1/65536 steps of the image size,
+    # finer than any pixel the cropper truncates to.
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4).astype(np.float64)
+    return zlib.crc32(np.round(boxes * 65536).astype(np.int64).tobytes())
+
+
+class CropManifest:
+    '''
+    Manifest initializations.
+    '''
+
+    def __init__(self, path, output=None):
+        self.path = path
+        self.output = output   # Sink settings, see Tools/shard_writer.py.
+        self.entries = dict()
+        self.lines = 0
+        self._lock = threading.Lock()
+        self._load()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a")
+
+    def _load(self):
+        if not os.path.exists(self.path): return
+        with open(self.path, "r") as f:
+            for line in f:
+                try: entry = json.loads(line)
+                except ValueError: continue   # Partly written line after a crash.
+                self.entries[entry["path"]] = entry
+                self.lines += 1
+
+
+    '''
+    Manifest functions.
+    '''
+
+    def is_done(self, path, mtime, padding, boxes):
+        entry = self.entries.get(path)
+        return entry is not None and entry["mtime"] == mtime and entry["padding"] == list(padding) and \
+               entry.get("output") == self.output and entry["boxes"] == len(boxes) and \
+               entry["crc"] == boxes_crc(boxes)
+
+    def record(self, path, mtime, padding, boxes):
+        entry = {"path": path, "mtime": mtime, "padding": list(padding), "output": self.output,
+                 "boxes": len(boxes), "crc": boxes_crc(boxes)}
+        with self._lock:
+            self.entries[path] = entry
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self.lines += 1
+
+    def compact(self):
+        with self._lock:
+            self._file.close()
+            temp = self.path + ".tmp"
+            with open(temp, "w") as f:
+                for entry in self.entries.values(): f.write(json.dumps(entry) + "\n")
+            os.replace(temp, self.path)
+            self.lines = len(self.entries)
+            self._file = open(self.path, "a")
+
+
+    '''
+    Manifest destructions.
+    '''
+
+    def close(self):
+        if self.lines > 2 * len(self.entries): self.compact()
+        with self._lock: self._file.close()
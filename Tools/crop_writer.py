@@ -0,0 +1,80 @@
+import cv2
+import queue
+import threading
+from time import time
+
+'''
+Asynchronous crop writer.
+Crops are encoded and written by worker threads from a bounded queue, so
+the interactive thread does not wait on JPEG encoding and disk latency.
+`write` blocks when the queue is full (backpressure), and `flush` waits
+until every queued crop is on disk. `write_func(path, img)` does the
+actual encoding and writing, `cv2.imwrite` by default.
+
+'''
+
+
+class CropWriter:
+    '''
+    Writer initializations.
+    '''
+
+    def __init__(self, maxsize=64, workers=2, on_change=None, write_func=None):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.write_func = write_func
+        self.on_change = on_change
+        self.writes = 0
+        self.errors = 0
+        self.latency = 0.    # Moving average of queue-to-disk time, in seconds.
+        self._lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._run, name="writerThread", daemon=True)
+                         for _ in range(workers)]
+        for worker in self._workers: worker.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: self.queue.task_done(); return
+            path, img, queued = item
+            try:
+                if self.write_func is not None: self.write_func(path, img)
+                elif not cv2.imwrite(path, img): raise IOError("Cannot write " + path)
+                with self._lock:
+                    self.writes += 1
+                    self.latency = 0.9 * self.latency + 0.1 * (time() - queued) if self.writes > 1 \
+                                   else time() - queued
+            except Exception as e:
+                print("Writer:", e)
+                with self._lock: self.errors += 1
+            finally: self.queue.task_done()
+            if self.on_change is not None: self.on_change()
+
+
+    '''
+    Writer functions.
+    '''
+
+    def write(self, path, img):
+        self.queue.put((path, img, time()))
+        if self.on_change is not None: self.on_change()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def flush(self):
+        self.queue.join()
+
+    def get_formatted_info(self):
+        s = "Writes: {} queued, {} done, {:.0f} ms".format(self.depth(), self.writes, self.latency * 1000)
+        if self.errors > 0: s += ", {} failed".format(self.errors)
+        return s
+
+
+    '''
+    Writer destructions.
+    '''
+
+    def close(self):
+        self.flush()
+        for _ in self._workers: self.queue.put(None)
+        for worker in self._workers: worker.join()
@@ -0,0 +1,141 @@
+import os
+import threading
+from array import array
+
+'''
+Recursive, lazy image directory scanning.
+`DirectoryScanner` walks a directory tree with `os.scandir` on a background
+thread and appends every file with a matching extension to a `PathTable`,
+so the first images can be used while the rest of the scan continues.
+Entries of each directory are visited in name order (files first, then
+sub-directories) to keep the order stable between sessions.
+
+'''
+
+DEFAULT_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+class PathTable:
+    '''
+    Compact, index addressable table of paths.
+    All paths are stored encoded in one byte buffer, with one array of
+    offsets into it, instead of one Python object per path.
+    A table created with growing=True is filled by a DirectoryScanner:
+    iterating it waits for new paths until `close` is called, while
+    `len` and indexing only see the paths found so far.
+    '''
+
+    def __init__(self, paths=(), growing=False):
+        self._buffer = bytearray()
+        self._offsets = array("q", [0])
+        self._grown = threading.Condition()
+        self._closed = False
+        for path in paths: self.append(path)
+        self._closed = not growing
+
+    def append(self, path):
+        with self._grown:
+            self._buffer += os.fsencode(str(path))
+            self._offsets.append(len(self._buffer))
+            self._grown.notify_all()
+
+    def close(self):
+        # No more paths will be appended.
+        with self._grown:
+            self._closed = True
+            self._grown.notify_all()
+
+    def is_complete(self):
+        return self._closed
+
+    def wait_for(self, count):
+        # Block until at least `count` paths are in the table, or it is closed.
+        with self._grown:
+            while len(self) < count and not self._closed:
+                self._grown.wait(0.5)
+        return len(self)
+
+    def join(self):
+        # Block until the table is closed, returns the final length.
+        with self._grown:
+            while not self._closed: self._grown.wait(0.5)
+        return len(self)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0: i += n
+        if i < 0 or i >= n: raise IndexError("PathTable index out of range")
+        return os.fsdecode(bytes(self._buffer[self._offsets[i]:self._offsets[i+1]]))
+
+    def __iter__(self):
+        # Waits for the paths still to be appended, ends once the table is closed.
+        i = 0
+        while self.wait_for(i + 1) > i:
+            yield self[i]
+            i += 1
+
+    def nbytes(self):
+        return len(self._buffer) + self._offsets.itemsize * len(self._offsets)
+
+
+class DirectoryScanner:
+    '''
+    Scanner initializations.
+    '''
+
+    def __init__(self, dir_path, extensions=DEFAULT_EXTENSIONS, exclude_dirs=("Output",), paths=None):
+        self.dir_path = dir_path
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.exclude_dirs = set(exclude_dirs)
+        self.paths = PathTable(growing=True) if paths is None else paths
+        self.done = threading.Event()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="scanThread", daemon=True)
+
+    def _scan(self, dir_path):
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e: print("Scan error:", e); return
+        dirs = list()
+        for entry in entries:
+            if self._stop: return
+            try:
+                if entry.is_dir():
+                    if entry.name not in self.exclude_dirs and not entry.name.startswith("."):
+                        dirs.append(entry.path)
+                elif entry.name.lower().endswith(self.extensions):
+                    self.paths.append(entry.path)
+            except OSError: pass
+        for path in dirs: self._scan(path)
+
+    def _run(self):
+        try: self._scan(self.dir_path)
+        finally:
+            self.paths.close()
+            self.done.set()
+            print(f"{len(self.paths)} images found.")
+
+
+    '''
+    Scanner functions.
+    '''
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def wait_for(self, count):
+        # Block until at least `count` paths are found, or the scan finished.
+        return self.paths.wait_for(count)
+
+    def join(self):
+        return self.paths.join()
+
+    def stop(self):
+        self._stop = True
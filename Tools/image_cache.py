@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+A memory bounded LRU cache of decoded images with background prefetching.
+`loader(key)` decodes (and resizes) the image for a key. Navigation asks
+the cache with `get`, and hints the images likely needed next with
+`prefetch` so they are decoded on worker threads ahead of time. The least
+recently used images are evicted once `max_bytes` is exceeded.
+
+'''
+
+
+class ImageCache:
+    '''
+    Cache initializations.
+    '''
+
+    def __init__(self, loader, max_bytes=256*1024*1024, workers=2):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.hits = 0     # Already decoded.
+        self.waits = 0    # Still being prefetched, waited for it.
+        self.misses = 0   # Decoded on the calling thread.
+        self._bytes = 0
+        self._images = OrderedDict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def _put(self, key, img):
+        # Caller holds the lock.
+        if img is None or key in self._images: return
+        self._images[key] = img
+        self._bytes += img.nbytes
+        while self._bytes > self.max_bytes and len(self._images) > 1:
+            _, old = self._images.popitem(last=False)
+            self._bytes -= old.nbytes
+
+    def _load(self, key):
+        try: img = self.loader(key)
+        except Exception as e: print("Prefetch error:", e, key); img = None
+        with self._lock:
+            self._pending.pop(key, None)
+            self._put(key, img)
+        return img
+
+
+    '''
+    Cache functions.
+    '''
+
+    def get(self, key):
+        with self._lock:
+            if key in self._images:
+                self.hits += 1
+                self._images.move_to_end(key)
+                return self._images[key]
+            future = self._pending.get(key)
+        if future is not None:
+            self.waits += 1
+            img = future.result()
+            if img is not None: return img
+        # Not cached, or prefetching failed: load here so errors reach the caller.
+        self.misses += 1
+        img = self.loader(key)
+        with self._lock: self._put(key, img)
+        return img
+
+    def prefetch(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._images or key in self._pending: continue
+                try: self._pending[key] = self._pool.submit(self._load, key)
+                except RuntimeError: return  # Cache closed.
+
+    def discard(self, key):
+        with self._lock:
+            img = self._images.pop(key, None)
+            if img is not None: self._bytes -= img.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+    def get_formatted_info(self):
+        return "Image cache: {} hits, {} waits, {} misses, {:.1f} MB".format(
+            self.hits, self.waits, self.misses, self._bytes / 1024 / 1024)
+
+
+    '''
+    Cache destructions.
+    '''
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.clear()
@@ -0,0 +1,73 @@
+import struct
+
+'''
+Read image dimensions from the file header only, without decoding pixels.
+Supports PNG, JPEG, BMP and WebP. `image_size` returns None for anything
+it cannot parse, so callers can fall back to a full `cv2.imread`.
+
+'''
+
+# JPEG start-of-frame markers, which carry the image size.
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b'\xff': byte = f.read(1)
+        while byte == b'\xff': byte = f.read(1)   # Fill bytes.
+        if not byte: return None
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9: continue   # No payload.
+        data = f.read(2)
+        if len(data) < 2: return None
+        length = struct.unpack('>H', data)[0]
+        if marker in _SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5: return None
+            height, width = struct.unpack('>HH', data[1:5])
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def _webp_size(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ' and len(head) >= 30:
+        width, height = struct.unpack('<HH', head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(head) >= 25:
+        b = head[21:25]
+        width = 1 + (((b[1] & 0x3F) << 8) | b[0])
+        height = 1 + (((b[3] & 0x0F) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6))
+        return width, height
+    if chunk == b'VP8X' and len(head) >= 30:
+        return 1 + int.from_bytes(head[24:27], 'little'), 1 + int.from_bytes(head[27:30], 'little')
+    return None
+
+
+def image_size(path):
+    '''
+    Get image size from file header.
+
+    Arguments:
+    ------------
+        path: str
+            Image file path.
+    ------------
+    Returns (width, height), or None if the format is not recognised.
+    Note the size is as stored, before any EXIF orientation is applied.
+
+    '''
+    with open(str(path), 'rb') as f:
+        head = f.read(32)
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head.startswith(b'\xff\xd8'):
+            return _jpeg_size(f)
+        if head.startswith(b'BM') and len(head) >= 26:
+            width, height = struct.unpack('<ii', head[18:26])
+            return width, abs(height)
+        if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+            return _webp_size(head)
+    return None
@@ -0,0 +1,190 @@
+import os
+import json
+import threading
+
+'''
+Append-only detection result store.
+Results of one directory are kept in "<dir>/output.jsonl", one
+{"path", "boxes"} line per image, appended and flushed as soon as the image
+is detected, so a crash loses at most the image being written. The whole
+file is read once into a {path: boxes} dict for keyed lookup. The latest
+line of a path wins; `compact` rewrites the file with one line per path.
+
+A legacy "output.json" (one dict of all results) is imported the first
+time a directory is opened, and left untouched.
+
+`ResultIndex` keeps one open store per directory, so each result file is
+parsed at most once however many paths are looked up, and results of
+several directories live side by side. A store is reloaded when its file
+was changed by someone else (mtime, size or inode differ from what the
+store last saw).
+
+'''
+
+FILE_NAME = "output.jsonl"
+LEGACY_FILE_NAME = "output.json"
+
+
+class ResultStore:
+    '''
+    Store initializations.
+    '''
+
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.path = os.path.join(dir_path, FILE_NAME)
+        self.entries = dict()   # {path: boxes}
+        self.lines = 0
+        self._lock = threading.Lock()
+        torn = False
+        if os.path.exists(self.path): torn = self._load()
+        else: self._import_legacy()
+        self._file = open(self.path, "a")
+        if torn: self._file.write("\n")   # Do not append to a partly written line.
+        self._file.flush()
+        self._stat = self._get_stat()
+
+    @staticmethod
+    def exists(dir_path):
+        # True if the directory has saved results, new or legacy.
+        return os.path.exists(os.path.join(dir_path, FILE_NAME)) or \
+               os.path.exists(os.path.join(dir_path, LEGACY_FILE_NAME))
+
+    def _load(self):
+        # Returns True if the last line is not terminated.
+        line = "\n"
+        with open(self.path, "r") as f:
+            for line in f:
+                try: entry = json.loads(line)
+                except ValueError: continue   # Partly written line after a crash.
+                self.entries[entry["path"]] = entry["boxes"]
+                self.lines += 1
+        return not line.endswith("\n")
+
+    def _import_legacy(self):
+        legacy = os.path.join(self.dir_path, LEGACY_FILE_NAME)
+        if not os.path.exists(legacy): return
+        try:
+            with open(legacy, "r") as f: self.entries = json.load(f)
+        except Exception as e: print("Cannot import", legacy, e); return
+        self._rewrite()
+
+
+    '''
+    Store functions.
+    '''
+
+    def _get_stat(self):
+        try: st = os.stat(self.path)
+        except OSError: return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def is_stale(self):
+        # True if the file was changed since this store last read or wrote it.
+        return self._get_stat() != self._stat
+
+    def get(self, path, default=None):
+        return self.entries.get(path, default)
+
+    def put(self, path, boxes):
+        '''
+        Arguments:
+        ------------
+            path: str
+                Image path or frame key.
+            boxes: list
+                [{"score": "CONFIDENCE (OPTIONAL)", "bbox": [X1, Y1, X2, Y2]}, ...]
+        ------------
+
+        '''
+        with self._lock:
+            self.entries[path] = boxes
+            self._file.write(json.dumps({"path": path, "boxes": boxes}) + "\n")
+            self._file.flush()
+            self.lines += 1
+            self._stat = self._get_stat()
+
+    def update(self, result):
+        for path in result: self.put(path, result[path])
+
+    def _rewrite(self):
+        # Caller holds the lock, or the file is not open yet.
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            for path, boxes in self.entries.items(): f.write(json.dumps({"path": path, "boxes": boxes}) + "\n")
+        os.replace(temp, self.path)
+        self.lines = len(self.entries)
+
+    def compact(self):
+        with self._lock:
+            self._file.close()
+            self._rewrite()
+            self._file = open(self.path, "a")
+            self._stat = self._get_stat()
+
+    def __getitem__(self, path):
+        return self.entries[path]
+
+    def __contains__(self, path):
+        return path in self.entries
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    '''
+    Store destructions.
+    '''
+
+    def close(self, compact=True):
+        if compact and self.lines > 2 * len(self.entries): self.compact()
+        with self._lock: self._file.close()
+
+
+class ResultIndex:
+    '''
+    Index initializations.
+    '''
+
+    def __init__(self):
+        self.stores = dict()   # {directory: ResultStore}
+        self._lock = threading.Lock()
+
+
+    '''
+    Index functions.
+    '''
+
+    def _store(self, path):
+        # Caller holds the lock, so no other thread uses a store while it is reloaded.
+        # Results are stored next to the images, or the video.
+        dir_path = os.path.split(path)[0]
+        store = self.stores.get(dir_path)
+        if store is not None and store.is_stale():
+            # Changed by another process, the entries in memory are outdated.
+            store.close(compact=False)
+            store = None
+        if store is None: store = self.stores[dir_path] = ResultStore(dir_path)
+        return store
+
+    def get(self, path, default=None):
+        with self._lock: return self._store(path).get(path, default)
+
+    def put(self, path, boxes):
+        with self._lock: self._store(path).put(path, boxes)
+
+    def update(self, result):
+        for path in result: self.put(path, result[path])
+
+
+    '''
+    Index destructions.
+    '''
+
+    def close(self):
+        with self._lock:
+            for store in self.stores.values(): store.close()
+            self.stores.clear()
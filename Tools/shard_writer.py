@@ -0,0 +1,184 @@
+import os
+import io
+import cv2
+import glob
+import json
+import tarfile
+import threading
+import numpy as np
+from time import time
+
+'''
+Output sinks for exported crops.
+A sink takes `write(path, img)` calls, where `path` is the file the crop
+would have been written to, and `close()` finishes any open shard.
+`on_saved(paths, callback)` calls `callback` once the crops written to
+`paths` are on disk, which is right away except for crops still buffered
+in an open npy shard. `settings` is what the sink writes (mode and the
+options that change the output), for the crop manifest.
+
+    FileSink   one JPEG per crop, as before.
+    TarSink    WebDataset style tar shards of `shard_size` JPEG members,
+               "shard-000000.tar" in the crop's directory, each with a
+               "shard-000000.tar.idx" JSON Lines index of
+               {"name", "offset", "size"} for random access to the member data.
+               Both are flushed after every member, a shard cut short by a
+               crash still reads up to its last member.
+    NpySink    uint8 arrays of `shard_size` crops resized to `size`x`size`,
+               "shard-000000.npy" with a "shard-000000.json" list of names.
+
+Shard numbers continue after the shards already in a directory, so reruns
+never overwrite earlier shards.
+
+'''
+
+
+def _next_shard(dir_path, ext):
+    numbers = [int(os.path.basename(p)[6:12]) for p in glob.glob(os.path.join(glob.escape(dir_path), "shard-*" + ext))
+               if os.path.basename(p)[6:12].isdigit()]
+    return max(numbers) + 1 if numbers else 0
+
+
+class FileSink:
+    def __init__(self):
+        self.settings = {"mode": "files"}
+
+    def write(self, path, img):
+        if not cv2.imwrite(path, img): raise IOError("Cannot write " + path)
+
+    def on_saved(self, paths, callback):
+        callback()
+
+    def close(self): pass
+
+
+class _TarShard:
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.tar = tarfile.open(path, "w")
+        self.index = open(path + ".idx", "w")
+
+    def add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time()
+        self.tar.addfile(info, io.BytesIO(data))
+        # Member data is padded to 512 byte blocks and ends at the current offset.
+        offset = self.tar.offset - (len(data) + 511) // 512 * 512
+        self.index.write(json.dumps({"name": name, "offset": offset, "size": len(data)}) + "\n")
+        self.tar.fileobj.flush()
+        self.index.flush()
+        self.count += 1
+
+    def close(self):
+        self.tar.close()
+        self.index.close()
+
+
+class TarSink:
+    def __init__(self, shard_size=1000, quality=95):
+        self.shard_size = shard_size
+        self.quality = quality
+        self.settings = {"mode": "tar", "quality": quality}
+        self._shards = dict()   # {directory: _TarShard}
+        self._lock = threading.Lock()
+
+    def write(self, path, img):
+        # Encode on the calling thread, only the append is serialized.
+        ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok: raise IOError("Cannot encode " + path)
+        dir_path, name = os.path.split(path)
+        with self._lock:
+            shard = self._shards.get(dir_path)
+            if shard is None:
+                os.makedirs(dir_path or ".", exist_ok=True)
+                shard_path = os.path.join(dir_path, "shard-%06d.tar" % _next_shard(dir_path, ".tar"))
+                shard = self._shards[dir_path] = _TarShard(shard_path)
+            shard.add(name, buf.tobytes())
+            if shard.count >= self.shard_size:
+                shard.close()
+                del self._shards[dir_path]
+
+    def on_saved(self, paths, callback):
+        # Members are flushed as they are added.
+        callback()
+
+    def close(self):
+        with self._lock:
+            for shard in self._shards.values(): shard.close()
+            self._shards.clear()
+
+
+class _NpyShard:
+    def __init__(self, dir_path, size, shard_size):
+        self.dir_path = dir_path
+        self.array = np.empty((shard_size, size, size, 3), dtype=np.uint8)
+        self.names = list()
+        self.waiters = list()   # [[shards left, callback]] of on_saved.
+
+    def add(self, name, img):
+        self.array[len(self.names)] = img
+        self.names.append(name)
+
+    def save(self):
+        # Returns the callbacks of on_saved that have no other shard to wait for.
+        name = "shard-%06d" % _next_shard(self.dir_path, ".npy")
+        np.save(os.path.join(self.dir_path, name + ".npy"), self.array[:len(self.names)])
+        with open(os.path.join(self.dir_path, name + ".json"), "w") as f: json.dump(self.names, f)
+        ready = list()
+        for waiter in self.waiters:
+            waiter[0] -= 1
+            if waiter[0] == 0: ready.append(waiter[1])
+        return ready
+
+
+class NpySink:
+    def __init__(self, size=256, shard_size=512):
+        self.size = size
+        self.shard_size = shard_size
+        self.settings = {"mode": "npy", "size": size}
+        self._shards = dict()   # {directory: _NpyShard}
+        self._lock = threading.Lock()
+
+    def write(self, path, img):
+        img = cv2.resize(img, (self.size, self.size), interpolation=cv2.INTER_AREA)
+        dir_path, name = os.path.split(path)
+        ready = list()
+        with self._lock:
+            shard = self._shards.get(dir_path)
+            if shard is None:
+                os.makedirs(dir_path or ".", exist_ok=True)
+                shard = self._shards[dir_path] = _NpyShard(dir_path, self.size, self.shard_size)
+            shard.add(name, img)
+            if len(shard.names) >= self.shard_size:
+                ready = shard.save()
+                del self._shards[dir_path]
+        for callback in ready: callback()
+
+    def on_saved(self, paths, callback):
+        with self._lock:
+            shards = list()
+            for path in paths:
+                dir_path, name = os.path.split(path)
+                shard = self._shards.get(dir_path)
+                if shard is not None and name in shard.names and shard not in shards: shards.append(shard)
+            if shards:
+                waiter = [len(shards), callback]
+                for shard in shards: shard.waiters.append(waiter)
+                return
+        callback()
+
+    def close(self):
+        ready = list()
+        with self._lock:
+            for shard in self._shards.values(): ready += shard.save()
+            self._shards.clear()
+        for callback in ready: callback()
+
+
+SINKS = {"files": FileSink, "tar": TarSink, "npy": NpySink}
+
+
+def make_sink(mode, **kwargs):
+    return SINKS[mode](**kwargs)
@@ -0,0 +1,37 @@
+import queue
+
+'''
+Bounded queue helpers for staged pipelines (batch_crop.py, the animeFace
+plugin). `put` and `get` block while the neighbouring stage is behind, but
+give up once the shared `stop` event is set, so a stage never waits
+forever on a stage that has exited. `None` marks the end of a stream.
+
+'''
+
+END = None   # End of stream marker.
+
+
+def put(q, item, stop, timeout=0.5):
+    # Returns False if stopped before the item was queued.
+    while not stop.is_set():
+        try: q.put(item, timeout=timeout); return True
+        except queue.Full: pass
+    return False
+
+
+def get(q, stop, timeout=0.5):
+    # Returns END once stopping.
+    while not stop.is_set():
+        try: return q.get(timeout=timeout)
+        except queue.Empty: pass
+    return END
+
+
+def get_batch(q, n, stop):
+    # Blocks for the first item, then takes what is already queued, up to n items.
+    # The END marker, if taken, is the last item.
+    items = [get(q, stop)]
+    while items[-1] is not END and len(items) < n:
+        try: items.append(q.get_nowait())
+        except queue.Empty: break
+    return items
@@ -0,0 +1,192 @@
+import os
+import cv2
+import json
+import bisect
+import threading
+from collections import OrderedDict
+
+'''
+Sequential video frame source with a ring buffer of recent frames.
+Setting `CAP_PROP_POS_FRAMES` before every read makes most codecs seek
+back to the previous keyframe and decode forward again. `VideoFrameSource`
+keeps decoding forward instead, and only seeks on a real jump: backwards
+past the ring buffer, or further ahead than `max_skip` frames. Frames
+that were returned recently are served from the ring buffer.
+
+With a `KeyframeIndex`, a jump seeks to the nearest preceding keyframe
+and decodes forward from there, or decodes forward from the current
+position when that is already past the keyframe.
+
+'''
+
+
+class KeyframeIndex:
+    '''
+    Keyframe positions of a video, persisted next to it as
+    `<video>.keyframes.json` and reused while the video is unchanged.
+    Building needs the FFmpeg backend with raw packet reading
+    (`CAP_PROP_LRF_HAS_KEY_FRAME`), which reads packets without decoding.
+    '''
+
+    def __init__(self, keyframes):
+        self.keyframes = keyframes
+
+    @staticmethod
+    def index_path(path):
+        return path + ".keyframes.json"
+
+    @staticmethod
+    def _signature(path):
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(cls.index_path(path), "r") as f: data = json.load(f)
+            if data["signature"] != cls._signature(path): return None
+            return cls(data["keyframes"])
+        except Exception: return None
+
+    @classmethod
+    def build(cls, path):
+        flag = getattr(cv2, "CAP_PROP_LRF_HAS_KEY_FRAME", None)
+        if flag is None: return None
+        cap = cv2.VideoCapture(path, cv2.CAP_FFMPEG)
+        try:
+            if not cap.isOpened() or not cap.set(cv2.CAP_PROP_FORMAT, -1): return None
+            keyframes = list()
+            i = 0
+            while cap.grab():
+                if cap.get(flag): keyframes.append(i)
+                i += 1
+        finally: cap.release()
+        if len(keyframes) < 1: return None
+        return cls(keyframes)
+
+    @classmethod
+    def load_or_build(cls, path):
+        index = cls.load(path)
+        if index is not None: return index
+        index = cls.build(path)
+        if index is not None: index.save(path)
+        return index
+
+    def save(self, path):
+        try:
+            with open(self.index_path(path), "w") as f:
+                json.dump({"signature": self._signature(path), "keyframes": self.keyframes}, f)
+        except Exception as e: print("Keyframe index:", e)
+
+    def preceding(self, index):
+        # Nearest keyframe at or before `index`.
+        i = bisect.bisect_right(self.keyframes, index) - 1
+        return self.keyframes[i] if i >= 0 else 0
+
+
+class VideoFrameSource:
+    '''
+    Source initializations.
+    '''
+
+    def __init__(self, path, capacity=32, max_skip=120, index_keyframes=True):
+        self.path = path
+        self.keyframes = None
+        self.cap = cv2.VideoCapture(path)
+        self.length = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.capacity = capacity
+        self.max_skip = max_skip
+        self.seeks = 0
+        self._pos = 0           # Index of the frame the decoder returns next.
+        self._ring = OrderedDict()
+        self._lock = threading.Lock()
+        if index_keyframes:
+            threading.Thread(target=self._load_keyframes, name="keyframeThread", daemon=True).start()
+
+    def _load_keyframes(self):
+        self.keyframes = KeyframeIndex.load_or_build(self.path)
+        if self.keyframes is not None:
+            print(f"{len(self.keyframes.keyframes)} keyframes indexed.")
+
+    def _need_seek(self, index):
+        # Returns the frame to seek to, or None to keep decoding forward.
+        if self.keyframes is None:
+            if index < self._pos or index - self._pos > self.max_skip: return index
+            return None
+        keyframe = self.keyframes.preceding(index)
+        if index < self._pos or keyframe > self._pos: return keyframe
+        return None
+
+    def _seek(self, index):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+        self._pos = index
+        self.seeks += 1
+
+    def _store(self, index, img):
+        self._ring[index] = img
+        while len(self._ring) > self.capacity: self._ring.popitem(last=False)
+
+
+    '''
+    Source functions.
+    '''
+
+    def read(self, index):
+        with self._lock:
+            if index in self._ring:
+                self._ring.move_to_end(index)
+                return self._ring[index]
+            target = self._need_seek(index)
+            if target is not None: self._seek(target)
+            # Frames in between are grabbed but not retrieved.
+            while self._pos < index:
+                if not self.cap.grab(): return None
+                self._pos += 1
+            ok, img = self.cap.read()
+            if not ok: return None
+            self._pos += 1
+            self._store(index, img)
+            return img
+
+    def close(self):
+        with self._lock:
+            self._ring.clear()
+            self.cap.release()
+
+
+class FrameList:
+    '''
+    Lazy, range backed list of the frame keys of a video.
+    Keys are "<video path>-<frame>" strings, the same keys used in
+    output.json, and are only built when indexed. Slicing returns another
+    FrameList, so striding a multi-hour video costs no memory.
+    '''
+
+    def __init__(self, video_path, frames):
+        self.video_path = video_path
+        self.frames = frames
+
+    def key(self, frame):
+        return f"{self.video_path}-{frame}"
+
+    def frame(self, i):
+        # Frame number at position `i`.
+        return self.frames[i]
+
+    def frame_of(self, key):
+        # Frame number of a key.
+        return int(str(key).rsplit("-", 1)[-1])
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice): return FrameList(self.video_path, self.frames[i])
+        return self.key(self.frames[i])
+
+    def __iter__(self):
+        for frame in self.frames: yield self.key(frame)
+
+    def __contains__(self, key):
+        try: return str(key).rsplit("-", 1)[0] == self.video_path and self.frame_of(key) in self.frames
+        except ValueError: return False
@@ -0,0 +1,73 @@
+import numpy as np
+import cv2
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plugin import Plugin
+
+'''
+Throughput of batched inference ("All faces" batch size) on the sample
+images, and the largest difference of the scores and boxes of each image
+against batch size 1. With the default -bucket 1 only images of the same
+size after the rescale share a batch; a larger -bucket zero pads images of
+similar size into one batch, which changes detections near the padding.
+
+    python benchmark_batch.py -sizes 1 2 4 8
+    python benchmark_batch.py -bucket 64
+
+'''
+
+
+class _NoImageHandler:
+    image_paths = None
+
+
+def diff(ref, out):
+    # Largest score and box difference, None if the number of ROIs differs.
+    (ref_scores, ref_boxes), (scores, boxes) = ref, out
+    if ref_scores.shape != scores.shape: return None
+    if len(scores) == 0: return 0.
+    return max(np.abs(ref_scores - scores).max(), np.abs(ref_boxes - boxes).max())
+
+
+def main():
+    base = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description='Anime face detector batch size benchmark')
+    parser.add_argument('-i', help='The sample image directory', dest='input', type=str,
+                        default=os.path.join(base, 'animeFace', 'asset'))
+    parser.add_argument('-n', help='Images per run, the samples are repeated', dest='n', default=8, type=int)
+    parser.add_argument('-sizes', help='Batch sizes to compare', nargs='+', dest='sizes', type=int,
+                        default=[1, 2, 4, 8])
+    parser.add_argument('-bucket', help='Bucket step in pixels, 1 for exact sizes', dest='bucket', default=1, type=int)
+    args = parser.parse_args()
+
+    samples = [cv2.imread(os.path.join(args.input, name)) for name in sorted(os.listdir(args.input))]
+    samples = [image for image in samples if image is not None]
+    images = [samples[i % len(samples)] for i in range(args.n)]
+    print('%d images of %d samples.' % (len(images), len(samples)))
+
+    plugin = Plugin(None, _NoImageHandler())
+    assert plugin.load(base), 'Cannot load the model'
+    plugin.bucket_step = args.bucket
+    ref = [plugin.detect(image) for image in images]   # Batch size 1, also the warm up.
+
+    print('%-10s %10s %8s %12s' % ('batch size', 'images/s', 'speedup', 'max diff'))
+    base_rate = None
+    for size in args.sizes:
+        plugin.detect_batch(images[:size])   # Warm up the batch shape.
+        time_start = time.perf_counter()
+        out = list()
+        for k in range(0, len(images), size): out += plugin.detect_batch(images[k:k+size])
+        rate = len(images) / (time.perf_counter() - time_start)
+        base_rate = base_rate or rate
+        diffs = [diff(r, o) for r, o in zip(ref, out)]
+        print('%-10d %10.3f %8.2f %12s' % (size, rate, rate / base_rate,
+                                           'ROIs differ' if None in diffs else '%.2e' % max(diffs)))
+    plugin.close()
+
+
+if __name__ == '__main__':
+    main()
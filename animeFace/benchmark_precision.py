@@ -0,0 +1,110 @@
+import numpy as np
+import cv2
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from plugin import Plugin
+from quantized_graph import precision_path, available
+
+'''
+Accuracy versus speed of the model precisions on the bundled samples.
+The float model is the reference. For every graph quantized by
+quantized_graph.py, reports the model size, the median detection time
+per image, and the recall, precision and mean score difference of its
+faces against the reference (matched at IoU >= -iou).
+
+    python quantized_graph.py -precision weights
+    python quantized_graph.py -precision eight_bit -calib /path/to/images
+    python benchmark_precision.py
+
+'''
+
+
+class _NoImageHandler:
+    image_paths = None
+
+
+def size_mb(path):
+    # A frozen graph, or the files of a checkpoint.
+    files = [path] if os.path.exists(path) else glob.glob(path + '.*')
+    return sum(os.path.getsize(file) for file in files) / 2**20
+
+
+def iou(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0: return 0.
+    inter = w * h
+    return inter / ((a[2]-a[0]) * (a[3]-a[1]) + (b[2]-b[0]) * (b[3]-b[1]) - inter)
+
+
+def match(ref, faces, thresh):
+    # Greedy one to one matching, returns the score differences of the matched pairs.
+    used = set()
+    diffs = list()
+    for r in ref:
+        best, best_iou = None, thresh
+        for j, face in enumerate(faces):
+            if j in used: continue
+            v = iou(r['bbox'], face['bbox'])
+            if v >= best_iou: best, best_iou = j, v
+        if best is not None:
+            used.add(best)
+            diffs.append(abs(r['score'] - faces[best]['score']))
+    return diffs
+
+
+def run(plugin, images, repeat):
+    result = dict()
+    times = list()
+    for name, image in images.items():
+        result[name] = plugin.detect_image(image)   # Warm up.
+        for _ in range(repeat):
+            t = time.perf_counter()
+            plugin.detect_image(image)
+            times.append(time.perf_counter() - t)
+    return result, np.median(times)
+
+
+def main():
+    base = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description='Anime face detector precision comparison')
+    parser.add_argument('-i', help='The sample image directory', dest='input', type=str,
+                        default=os.path.join(base, 'animeFace', 'asset'))
+    parser.add_argument('-n', help='Timed runs per image', dest='repeat', default=3, type=int)
+    parser.add_argument('-iou', help='IoU threshold of a match', dest='iou', type=float, default=0.5)
+    parser.add_argument('-conf', help='Score threshold of a face', dest='conf_thresh', type=float, default=0.8)
+    args = parser.parse_args()
+
+    images = {name: cv2.imread(os.path.join(args.input, name)) for name in sorted(os.listdir(args.input))}
+    images = {name: image for name, image in images.items() if image is not None}
+    print('%d sample images.' % len(images))
+
+    plugin = Plugin(None, _NoImageHandler())
+    assert plugin.load(base), 'Cannot load the model'
+    plugin.conf_thresh = args.conf_thresh
+    precisions = available(plugin.model_dir)
+    if len(precisions) == 1: print('No quantized model, make one with quantized_graph.py.')
+
+    print('%-10s %8s %10s %8s %8s %8s %10s %10s' % ('precision', 'MB', 'ms/image', 'speedup', 'faces', 'recall',
+                                                    'precision', 'score diff'))
+    ref, ref_time, ref_n = None, None, None
+    for precision in precisions:
+        if not plugin.set_precision(precision): continue
+        result, t = run(plugin, images, args.repeat)
+        n = sum(len(faces) for faces in result.values())
+        if ref is None: ref, ref_time, ref_n = result, t, n
+        diffs = sum((match(ref[name], result[name], args.iou) for name in ref), list())
+        print('%-10s %8.1f %10.1f %8.2f %8d %8.3f %10.3f %10.4f' % (
+            precision, size_mb(precision_path(plugin.model_dir, precision)), t * 1000,
+            ref_time / t, n, len(diffs) / ref_n if ref_n else 1., len(diffs) / n if n else 1.,
+            np.mean(diffs) if diffs else 0.))
+    plugin.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import numpy as np
+import cv2
+import argparse
+import os
+import time
+import tracemalloc
+from preprocess import rescale, BatchBuffer
+
+'''
+Compares the old Faster-RCNN preprocessing (float32 copy of the full image,
+mean subtraction, then resize) with `preprocess` (resize the uint8 image,
+then normalize into a reused buffer), for latency and peak memory.
+
+    python benchmark_preprocess.py
+    python benchmark_preprocess.py -i /path/to/image.jpg
+
+'''
+
+
+def float_first(image):
+    img_origin = image.astype(np.float32, copy=True)
+    img_origin -= np.array([[[102.9801, 115.9465, 112.7717]]])
+
+    img_shape = img_origin.shape
+    img_size_min = np.min(img_shape[:2])
+    img_size_max = np.max(img_shape[:2])
+
+    img_scale = 600 / img_size_min
+    if np.round(img_scale * img_size_max) > 1000:
+        img_scale = 1000 / img_size_max
+    img = cv2.resize(img_origin, None, None, img_scale, img_scale, cv2.INTER_LINEAR)
+    img_info = np.array([img.shape[0], img.shape[1], img_scale], dtype=np.float32)
+    img = np.expand_dims(img, 0)
+    return img, img_info
+
+
+def resize_first(image, buffers):
+    return buffers.fill([rescale(image)])
+
+
+def measure(func, repeat):
+    func()   # Warm up, and allocate the reused buffers.
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times = list()
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    return np.median(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Faster-RCNN preprocessing benchmark')
+    parser.add_argument('-i', help='Image to use instead of random frames', dest='input', type=str)
+    parser.add_argument('-n', help='Repeats per size', dest='repeat', default=20, type=int)
+    args = parser.parse_args()
+
+    if args.input is not None:
+        assert os.path.exists(args.input), 'The input path does not exists'
+        images = {os.path.basename(args.input): cv2.imread(args.input)}
+    else:
+        rng = np.random.default_rng(0)
+        images = {name: rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+                  for name, (h, w) in [('720p', (720, 1280)), ('1080p', (1080, 1920)), ('4K', (2160, 3840))]}
+
+    buffers = BatchBuffer()
+    print('%-10s %12s %12s %12s %12s %10s' % ('image', 'old ms', 'new ms', 'old peak MB', 'new peak MB', 'max diff'))
+    for name, image in images.items():
+        old_t, old_peak = measure(lambda: float_first(image), args.repeat)
+        new_t, new_peak = measure(lambda: resize_first(image, buffers), args.repeat)
+        # uint8 interpolation is fixed point and rounded, the difference stays below one level.
+        diff = np.abs(float_first(image)[0] - resize_first(image, buffers)[0]).max()
+        print('%-10s %12.2f %12.2f %12.1f %12.1f %10.2f' % (name, old_t * 1000, new_t * 1000, old_peak / 2**20,
+                                                            new_peak / 2**20, diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import time
+time_start = time.time()
+import argparse
+import os
+import subprocess
+import sys
+import numpy as np
+
+'''
+Cold start of the anime face detector: a fresh process imports
+TensorFlow, loads the model and detects one image, for a checkpoint and
+for the frozen graph of frozen_graph.py. Reports the median of -n runs.
+
+    python frozen_graph.py
+    python benchmark_startup.py -image asset/sample1.png
+
+'''
+
+
+def child(model, image):
+    # Runs in the fresh process, prints the times since start.
+    import cv2
+    import tensorflow as tf
+    time_import = time.time()
+    from frozen_graph import load
+    from main import detect
+    cfg = tf.ConfigProto()
+    cfg.gpu_options.allow_growth = True
+    sess, net = load(model, cfg)
+    time_load = time.time()
+    detect(sess, net, cv2.imread(image))
+    time_detect = time.time()
+    print('%f %f %f' % (time_import - time_start, time_load - time_import, time_detect - time_load))
+
+
+def main():
+    from frozen_graph import CHECKPOINT, FROZEN_GRAPH
+    parser = argparse.ArgumentParser(description='Anime face detector cold start benchmark')
+    parser.add_argument('-models', help='Models to compare', nargs='+', dest='models', type=str,
+                        default=[os.path.join('model', CHECKPOINT), os.path.join('model', FROZEN_GRAPH)])
+    parser.add_argument('-image', help='The image of the first detection', dest='image', type=str,
+                        default=os.path.join('asset', 'sample1.png'))
+    parser.add_argument('-n', help='Runs per model', dest='repeat', default=3, type=int)
+    parser.add_argument('-child', help=argparse.SUPPRESS, dest='child', type=str)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child, args.image)
+        return
+
+    print('%-45s %10s %10s %12s %10s' % ('model', 'import s', 'load s', 'first det s', 'total s'))
+    for model in args.models:
+        runs = list()
+        for _ in range(args.repeat):
+            out = subprocess.run([sys.executable, __file__, '-child', model, '-image', args.image],
+                                 stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            runs.append([float(v) for v in out.strip().split('\n')[-1].split()])
+        t_import, t_load, t_detect = np.median(np.array(runs), axis=0)
+        print('%-45s %10.2f %10.2f %12.2f %10.2f' % (model, t_import, t_load, t_detect,
+                                                     t_import + t_load + t_detect))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,8 +12,9 @@ class FasterRCNNSlim:
                         resnet_v1_block('block2', base_depth=128, num_units=4, stride=2),
                         resnet_v1_block('block3', base_depth=256, num_units=23, stride=1),
                         resnet_v1_block('block4', base_depth=512, num_units=3, stride=1)]
-        self._image = tf.placeholder(tf.float32, shape=[1, None, None, 3])
-        self._im_info = tf.placeholder(tf.float32, shape=[3])
+        # A batch of images zero padded to a common size, im_info is [height, width, scale] of each image.
+        self._image = tf.placeholder(tf.float32, shape=[None, None, None, 3], name='image')
+        self._im_info = tf.placeholder(tf.float32, shape=[None, 3], name='im_info')
 
         self._anchor_scales = [4, 8, 16, 32]
         self._num_scales = len(self._anchor_scales)
@@ -44,8 +45,9 @@ class FasterRCNNSlim:
             with tf.variable_scope(self._scope, self._scope):
                 # in _anchor_component
                 with tf.variable_scope('ANCHOR-default'):
-                    height = tf.to_int32(tf.ceil(self._im_info[0] / 16.0))
-                    width = tf.to_int32(tf.ceil(self._im_info[1] / 16.0))
+                    # Anchors cover the (padded) feature map, ceil(im_info / 16) for an unpadded image.
+                    height = tf.shape(net_conv)[1]
+                    width = tf.shape(net_conv)[2]
 
                     shift_x = tf.range(width) * 16
                     shift_y = tf.range(height) * 16
@@ -86,42 +88,54 @@ class FasterRCNNSlim:
                     post_nms_topn = 300
                     nms_thresh = 0.7
                     scores = rpn_cls_prob[:, :, :, self._num_anchors:]
-                    scores = tf.reshape(scores, [-1])
-                    rpn_bbox_pred = tf.reshape(rpn_bbox_pred, [-1, 4])
-
-                    boxes = tf.cast(self._anchors, rpn_bbox_pred.dtype)
-                    widths = boxes[:, 2] - boxes[:, 0] + 1.0
-                    heights = boxes[:, 3] - boxes[:, 1] + 1.0
-                    ctr_x = boxes[:, 0] + widths * 0.5
-                    ctr_y = boxes[:, 1] + heights * 0.5
-
-                    dx = rpn_bbox_pred[:, 0]
-                    dy = rpn_bbox_pred[:, 1]
-                    dw = rpn_bbox_pred[:, 2]
-                    dh = rpn_bbox_pred[:, 3]
-
-                    pred_ctr_x = dx * widths + ctr_x
-                    pred_ctr_y = dy * heights + ctr_y
-                    pred_w = tf.exp(dw) * widths
-                    pred_h = tf.exp(dh) * heights
-
-                    pred_boxes0 = pred_ctr_x - pred_w * 0.5
-                    pred_boxes1 = pred_ctr_y - pred_h * 0.5
-                    pred_boxes2 = pred_ctr_x + pred_w * 0.5
-                    pred_boxes3 = pred_ctr_y + pred_h * 0.5
-
-                    b0 = tf.clip_by_value(pred_boxes0, 0, self._im_info[1] - 1)
-                    b1 = tf.clip_by_value(pred_boxes1, 0, self._im_info[0] - 1)
-                    b2 = tf.clip_by_value(pred_boxes2, 0, self._im_info[1] - 1)
-                    b3 = tf.clip_by_value(pred_boxes3, 0, self._im_info[0] - 1)
-
-                    proposals = tf.stack([b0, b1, b2, b3], axis=1)
-                    indices = tf.image.non_max_suppression(proposals, scores, max_output_size=post_nms_topn,
-                                                           iou_threshold=nms_thresh)
-                    boxes = tf.to_float(tf.gather(proposals, indices))
-                    # rpn_scores = tf.reshape(tf.gather(scores, indices), [-1, 1])
-
-                    batch_inds = tf.zeros([tf.shape(indices)[0], 1], dtype=tf.float32)
+                    scores = tf.reshape(scores, [tf.shape(scores)[0], -1])
+                    rpn_bbox_pred = tf.reshape(rpn_bbox_pred, [tf.shape(rpn_bbox_pred)[0], -1, 4])
+
+                    def image_proposals(inputs):
+                        # Proposals of one image, padded to post_nms_topn rows.
+                        scores, rpn_bbox_pred, im_info = inputs
+                        boxes = tf.cast(self._anchors, rpn_bbox_pred.dtype)
+                        widths = boxes[:, 2] - boxes[:, 0] + 1.0
+                        heights = boxes[:, 3] - boxes[:, 1] + 1.0
+                        ctr_x = boxes[:, 0] + widths * 0.5
+                        ctr_y = boxes[:, 1] + heights * 0.5
+
+                        dx = rpn_bbox_pred[:, 0]
+                        dy = rpn_bbox_pred[:, 1]
+                        dw = rpn_bbox_pred[:, 2]
+                        dh = rpn_bbox_pred[:, 3]
+
+                        pred_ctr_x = dx * widths + ctr_x
+                        pred_ctr_y = dy * heights + ctr_y
+                        pred_w = tf.exp(dw) * widths
+                        pred_h = tf.exp(dh) * heights
+
+                        pred_boxes0 = pred_ctr_x - pred_w * 0.5
+                        pred_boxes1 = pred_ctr_y - pred_h * 0.5
+                        pred_boxes2 = pred_ctr_x + pred_w * 0.5
+                        pred_boxes3 = pred_ctr_y + pred_h * 0.5
+
+                        # Clipped to the image itself, not to the padded batch.
+                        b0 = tf.clip_by_value(pred_boxes0, 0, im_info[1] - 1)
+                        b1 = tf.clip_by_value(pred_boxes1, 0, im_info[0] - 1)
+                        b2 = tf.clip_by_value(pred_boxes2, 0, im_info[1] - 1)
+                        b3 = tf.clip_by_value(pred_boxes3, 0, im_info[0] - 1)
+
+                        proposals = tf.stack([b0, b1, b2, b3], axis=1)
+                        indices = tf.image.non_max_suppression(proposals, scores, max_output_size=post_nms_topn,
+                                                               iou_threshold=nms_thresh)
+                        boxes = tf.to_float(tf.gather(proposals, indices))
+                        # rpn_scores = tf.reshape(tf.gather(scores, indices), [-1, 1])
+                        count = tf.shape(indices)[0]
+                        return tf.pad(boxes, [[0, post_nms_topn - count], [0, 0]]), count
+
+                    boxes, counts = tf.map_fn(image_proposals, (scores, rpn_bbox_pred, self._im_info),
+                                              dtype=(tf.float32, tf.int32))
+                    # Drop the padding rows, rois are [batch index, x1, y1, x2, y2] in image order.
+                    mask = tf.sequence_mask(counts, post_nms_topn)
+                    batch_inds = tf.tile(tf.expand_dims(tf.range(tf.shape(counts)[0]), 1), [1, post_nms_topn])
+                    batch_inds = tf.to_float(tf.expand_dims(tf.boolean_mask(batch_inds, mask), 1))
+                    boxes = tf.boolean_mask(boxes, mask)
                     rois = tf.concat([batch_inds, boxes], 1)
 
                 # in _crop_pool_layer
@@ -159,6 +173,13 @@ class FasterRCNNSlim:
         self._bbox_pred *= stds
         self._bbox_pred += means
 
+        # Stable names for the fetched tensors, see frozen_graph.OUTPUTS.
+        with tf.name_scope('output'):
+            self._cls_score = tf.identity(self._cls_score, name='cls_score')
+            self._cls_prob = tf.identity(self._cls_prob, name='cls_prob')
+            self._bbox_pred = tf.identity(self._bbox_pred, name='bbox_pred')
+            self._rois = tf.identity(self._rois, name='rois')
+
     @staticmethod
     def _resnet_arg_scope():
         batch_norm_params = {
@@ -184,7 +205,7 @@ class FasterRCNNSlim:
         input_shape = tf.shape(bottom)
         with tf.variable_scope(name):
             to_caffe = tf.transpose(bottom, [0, 3, 1, 2])
-            reshaped = tf.reshape(to_caffe, [1, num_dim, -1, input_shape[2]])
+            reshaped = tf.reshape(to_caffe, [input_shape[0], num_dim, -1, input_shape[2]])
             to_tf = tf.transpose(reshaped, [0, 2, 3, 1])
         return to_tf
 
@@ -198,7 +219,9 @@ class FasterRCNNSlim:
         return tf.nn.softmax(bottom, name=name)
 
     def test_image(self, sess, image, im_info):
+        # image is [batch, height, width, 3], im_info is [3] for a single image or [batch, 3].
+        # rois[:, 0] is the index of the image each ROI belongs to.
         return sess.run([self._cls_score, self._cls_prob, self._bbox_pred, self._rois], feed_dict={
             self._image: image,
-            self._im_info: im_info
+            self._im_info: np.reshape(im_info, [-1, 3])
         })
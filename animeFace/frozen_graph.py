@@ -0,0 +1,136 @@
+import numpy as np
+import tensorflow as tf
+import argparse
+import os
+import time
+
+'''
+Frozen inference graph of FasterRCNNSlim.
+`export` builds the graph once, restores the training checkpoint and
+writes a GraphDef with the variables folded into constants, keeping only
+the nodes the fetched outputs depend on. `FrozenRCNN` imports that
+GraphDef and has the same `test_image` as FasterRCNNSlim, so loading
+skips importing slim, building the graph in Python and restoring
+variables.
+
+    python frozen_graph.py -model model/res101_faster_rcnn_iter_60000.ckpt -o model/frozen_inference_graph.pb
+
+'''
+
+CHECKPOINT = 'res101_faster_rcnn_iter_60000.ckpt'
+FROZEN_GRAPH = 'frozen_inference_graph.pb'
+
+# Graph node names of the inputs and of the outputs fetched by test_image.
+INPUTS = ['image', 'im_info']
+OUTPUTS = ['output/cls_score', 'output/cls_prob', 'output/bbox_pred', 'output/rois']
+
+
+def resolve_model(model_dir):
+    # The frozen graph if it was exported from the current checkpoint, else the checkpoint.
+    frozen = os.path.join(model_dir, FROZEN_GRAPH)
+    checkpoint = os.path.join(model_dir, CHECKPOINT)
+    if not os.path.exists(frozen): return checkpoint
+    index = checkpoint + '.index'
+    if os.path.exists(index) and os.path.getmtime(index) > os.path.getmtime(frozen):
+        print('%s is older than the checkpoint, using the checkpoint. Export it again with frozen_graph.py.' % frozen)
+        return checkpoint
+    print('Using the frozen graph %s, delete it to use the checkpoint.' % frozen)
+    return frozen
+
+
+def _optimize(graph_def):
+    # Constant folding and batch norm folding, when graph_transforms is built in.
+    # Identity nodes are not removed here: the outputs are Identity nodes, and
+    # remove_training_nodes already dropped the others.
+    try: from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError: print('graph_transforms not available, the graph is only frozen.'); return graph_def
+    graph_def = TransformGraph(graph_def, INPUTS, OUTPUTS,
+                               ['strip_unused_nodes', 'remove_nodes(op=CheckNumerics)',
+                                'fold_constants(ignore_errors=true)', 'fold_batch_norms', 'fold_old_batch_norms',
+                                'sort_by_execution_order'])
+    names = set(node.name for node in graph_def.node)
+    missing = [name for name in INPUTS + OUTPUTS if name not in names]
+    assert len(missing) == 0, 'Optimization removed %s' % ', '.join(missing)
+    return graph_def
+
+
+def export(checkpoint, output, optimize=True):
+    from faster_rcnn_wrapper import FasterRCNNSlim
+    graph = tf.Graph()
+    with graph.as_default():
+        FasterRCNNSlim()
+        saver = tf.train.Saver()
+        with tf.Session() as sess:
+            saver.restore(sess, checkpoint)
+            graph_def = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), list(OUTPUTS))
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=OUTPUTS)
+    if optimize: graph_def = _optimize(graph_def)
+    with tf.gfile.GFile(output, 'wb') as f: f.write(graph_def.SerializeToString())
+    print('%d nodes, %.1f MB written to %s' % (len(graph_def.node), os.path.getsize(output) / 2**20, output))
+
+
+def read_graph_def(path):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as f: graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+class FrozenRCNN:
+    def __init__(self, path, graph_def=None):
+        if graph_def is None: graph_def = read_graph_def(path)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self._image, self._im_info = [self.graph.get_tensor_by_name(name + ':0') for name in INPUTS]
+        self._outputs = [self.graph.get_tensor_by_name(name + ':0') for name in OUTPUTS]
+
+    def test_image(self, sess, image, im_info):
+        # Same as FasterRCNNSlim.test_image, `sess` must run on self.graph.
+        return sess.run(self._outputs, feed_dict={
+            self._image: image,
+            self._im_info: np.reshape(im_info, [-1, 3])
+        })
+
+
+def load(model, config=None):
+    '''
+    Arguments:
+    ------------
+        model: str
+            A frozen graph (.pb) or a training checkpoint.
+        config: tf.ConfigProto
+    ------------
+    Returns (sess, net), net has test_image(sess, image, im_info).
+
+    '''
+    if model.endswith('.pb'):
+        net = FrozenRCNN(model)
+        return tf.Session(graph=net.graph, config=config), net
+    from faster_rcnn_wrapper import FasterRCNNSlim   # Slow to import, only for checkpoints.
+    graph = tf.Graph()
+    with graph.as_default():
+        net = FasterRCNNSlim()
+        saver = tf.train.Saver()
+    sess = tf.Session(graph=graph, config=config)
+    saver.restore(sess, model)
+    return sess, net
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a frozen inference graph of the anime face detector')
+    parser.add_argument('-model', help='The checkpoint to export', dest='model', type=str,
+                        default=os.path.join('model', CHECKPOINT))
+    parser.add_argument('-o', help='The output graph path', dest='output', type=str,
+                        default=os.path.join('model', FROZEN_GRAPH))
+    parser.add_argument('-no-optimize', help='Only freeze, skip constant folding', dest='optimize',
+                        action='store_false')
+    args = parser.parse_args()
+
+    time_start = time.time()
+    export(args.model, args.output, args.optimize)
+    print('Exported in %.1f s.' % (time.time() - time_start))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,28 @@
 import numpy as np
 import cv2
-from faster_rcnn_wrapper import FasterRCNNSlim
 import tensorflow as tf
 import argparse
 import os
 import json
 import time
 from nms_wrapper import NMSType, NMSWrapper
+from preprocess import rescale, BatchBuffer
+from frozen_graph import load as load_model
+from quantized_graph import PRECISIONS, precision_path
 
 
-def detect(sess, rcnn_cls, image):
-    # pre-processing image for Faster-RCNN
-    img_origin = image.astype(np.float32, copy=True)
-    img_origin -= np.array([[[102.9801, 115.9465, 112.7717]]])
+_buffers = BatchBuffer()
 
-    img_shape = img_origin.shape
-    img_size_min = np.min(img_shape[:2])
-    img_size_max = np.max(img_shape[:2])
 
-    img_scale = 600 / img_size_min
-    if np.round(img_scale * img_size_max) > 1000:
-        img_scale = 1000 / img_size_max
-    img = cv2.resize(img_origin, None, None, img_scale, img_scale, cv2.INTER_LINEAR)
-    img_info = np.array([img.shape[0], img.shape[1], img_scale], dtype=np.float32)
-    img = np.expand_dims(img, 0)
+def detect(sess, rcnn_cls, image):
+    # pre-processing image for Faster-RCNN: resize the uint8 image, then normalize into a reused buffer
+    img_shape = image.shape
+    img, img_scale = rescale(image)
 
     # test image
-    _, scores, bbox_pred, rois = rcnn_cls.test_image(sess, img, img_info)
+    with _buffers.lock:
+        batch, img_info = _buffers.fill([(img, img_scale)])
+        _, scores, bbox_pred, rois = rcnn_cls.test_image(sess, batch, img_info)
 
     # bbox transform
     boxes = rois[:, 1:] / img_scale
@@ -88,12 +84,15 @@ def main():
                         dest='nms_thresh', default=0.3, type=float)
     parser.add_argument('-conf', help='Change the threshold for class regression', dest='conf_thresh',
                         default=0.8, type=float)
-    parser.add_argument('-model', help='Specify a new path for model', dest='model', type=str,
-                        default='model/res101_faster_rcnn_iter_60000.ckpt')
+    parser.add_argument('-model', help='Specify a new path for model, a checkpoint or a frozen graph (.pb), '
+                        'default the exported frozen graph if any, else the checkpoint', dest='model', type=str)
+    parser.add_argument('-precision', help='Model precision without -model, the reduced ones are made by '
+                        'quantized_graph.py', choices=PRECISIONS, dest='precision', default='float')
     parser.add_argument('-nms-type', help='Type of nms', choices=['PY_NMS', 'CPU_NMS', 'GPU_NMS'], dest='nms_type',
                         default='CPU_NMS')
 
     args = parser.parse_args()
+    if args.model is None: args.model = precision_path('model', args.precision)
 
     assert os.path.exists(args.input), 'The input path does not exists'
 
@@ -116,12 +115,9 @@ def main():
 
     cfg = tf.ConfigProto()
     cfg.gpu_options.allow_growth = True
-    sess = tf.Session(config=cfg)
-
-    net = FasterRCNNSlim()
-    saver = tf.train.Saver()
-
-    saver.restore(sess, args.model)
+    time_load = time.time()
+    sess, net = load_model(args.model, cfg)
+    print('%s loaded in %s' % (args.model, fmt_time(time.time() - time_load)))
 
     result = {}
 
@@ -5,35 +5,30 @@ import os
 import cv2
 import json
 import time
+import queue
+import threading
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Tools.result_store import ResultIndex
+from Tools import stage_queue
 import tensorflow as tf
 from nms_wrapper import NMSType, NMSWrapper
-from faster_rcnn_wrapper import FasterRCNNSlim 
+from preprocess import rescale, BatchBuffer
+from frozen_graph import load as load_model
+from quantized_graph import precision_path, available as available_precisions
 
 class Plugin: 
     '''
     Core functions 
     '''
 
-    def detect(self, image):
-        # pre-processing image for Faster-RCNN
-        img_origin = image.astype(np.float32, copy=True)
-        img_origin -= np.array([[[102.9801, 115.9465, 112.7717]]])
-
-        img_shape = img_origin.shape
-        img_size_min = np.min(img_shape[:2])
-        img_size_max = np.max(img_shape[:2])
-
-        img_scale = 600 / img_size_min
-        if np.round(img_scale * img_size_max) > 1000:
-            img_scale = 1000 / img_size_max
-        img = cv2.resize(img_origin, None, None, img_scale, img_scale, cv2.INTER_LINEAR)
-        img_info = np.array([img.shape[0], img.shape[1], img_scale], dtype=np.float32)
-        img = np.expand_dims(img, 0)
-
-        # test image
-        _, scores, bbox_pred, rois = self.net.test_image(self.sess, img, img_info)
+    def _preprocess(self, image):
+        # pre-processing image for Faster-RCNN, returns the resized uint8 image and its scale
+        # (mean subtraction happens in _infer, while filling the batch buffer)
+        return rescale(image)
 
+    def _decode(self, scores, bbox_pred, rois, img_scale, img_shape):
         # bbox transform
         boxes = rois[:, 1:] / img_scale
 
@@ -62,6 +57,40 @@ class Plugin:
         pred_boxes[:, 3::4] = np.minimum(pred_boxes[:, 3::4], img_shape[0] - 1)
         return scores, pred_boxes
 
+    def detect(self, image):
+        prepped = self._preprocess(image)
+        scores, bbox_pred, rois = self._infer([prepped])[0]
+        return self._decode(scores, bbox_pred, rois, prepped[1], image.shape)
+
+    def _bucket(self, shape):
+        # Images of a bucket differ by less than bucket_step pixels per side after the rescale.
+        # With bucket_step 1 only images of the same size share a batch, so nothing is zero padded
+        # and the detections are the same as one image at a time. Padding changes the features
+        # near the padded edges, and with them the proposals and scores.
+        return int(np.ceil(shape[0] / self.bucket_step)), int(np.ceil(shape[1] / self.bucket_step))
+
+    def detect_batch(self, images):
+        # Same as detect for a list of images, with one session call per size bucket.
+        prepped = [self._preprocess(image) for image in images]
+        return [self._decode(scores, bbox_pred, rois, img_scale, image.shape)
+                for image, (_, img_scale), (scores, bbox_pred, rois) in zip(images, prepped, self._infer(prepped))]
+
+    def _infer(self, prepped):
+        # Runs preprocessed (img, img_scale) pairs, returns (scores, bbox_pred, rois) of each.
+        buckets = dict()
+        for i, (img, _) in enumerate(prepped): buckets.setdefault(self._bucket(img.shape), list()).append(i)
+
+        output = [None] * len(prepped)
+        for ids in buckets.values():
+            with self.buffers.lock:
+                batch, img_info = self.buffers.fill([prepped[i] for i in ids])
+                _, scores, bbox_pred, rois = self.net.test_image(self.sess, batch, img_info)
+            # Split the ROIs back out per image.
+            owner = rois[:, 0].astype(np.int64)
+            for j, i in enumerate(ids):
+                keep = owner == j
+                output[i] = (scores[keep], bbox_pred[keep], rois[keep])
+        return output
 
     def fmt_time(self, dtime):
         if dtime <= 0:
@@ -78,29 +107,59 @@ class Plugin:
     '''
     Plugin initializations 
     '''
-    def __init__(self, interface, image_handler): 
-        self.result = dict() 
+    def __init__(self, interface, image_handler, batch_size=4, readers=4, precision="float"): 
+        self.results = ResultIndex()   # Saved results, by directory. 
         self.interface = interface 
         self.image_handler = image_handler 
         self.nms_thresh = 0.3 
         self.conf_thresh = 0.8 
         self.nms_type = NMSType.CPU_NMS
         self.nms = NMSWrapper(self.nms_type)
+        self.batch_size = batch_size   # Images per session call for "All faces". 
+        self.bucket_step = 1   # Exact sizes, see _bucket. 
+        self.buffers = BatchBuffer()   # Reused float32 input batches. 
+        self.readers = readers   # Threads decoding and preprocessing ahead of inference. 
+        self.progress_interval = 0.1   # Seconds between progressbar updates. 
+        self.precision = precision   # "float", or a graph of quantized_graph.py, "weights" or "eight_bit". 
+        self.sess = None 
         self.funcs = [{"name": "Detect face", "func": self.predict, "args": None}, 
                       {"name": "All faces", "func": self.predict, "args": self.image_handler.image_paths}] 
+        # Settings, listed in the plugin menu. 
+        self.options = [{"name": "Batch size: %d" % size, "func": self.set_batch_size, "args": size} 
+                        for size in (1, 2, 4, 8)] 
 
     def load(self, base): 
+        self.model_dir = os.path.join(base, "animeFace", "model") 
+        # Precisions quantized by quantized_graph.py, to switch to from the menu. 
+        precisions = available_precisions(self.model_dir) 
+        if len(precisions) > 1: 
+            self.options += [{"name": "Precision: " + precision, "func": self.set_precision, "args": precision} 
+                             for precision in precisions] 
+        return self.set_precision(self.precision) 
+
+    def set_precision(self, precision): 
         cfg = tf.ConfigProto()
         cfg.gpu_options.allow_growth = True
-        self.sess = tf.Session(config=cfg)
-        self.net = FasterRCNNSlim() 
-        saver = tf.train.Saver()
-        path = os.path.join(base, "animeFace/model/res101_faster_rcnn_iter_60000.ckpt")
+        # float is the frozen graph of frozen_graph.py if exported (it skips building the graph and 
+        # restoring), else the checkpoint. 
+        path = precision_path(self.model_dir, precision) 
         try: 
-            saver.restore(self.sess, path) 
-        except: print("animeFace:", path); return False 
+            time_load = time.time() 
+            sess, net = load_model(path, cfg) 
+            print("animeFace: {} loaded in {}".format(os.path.basename(path), self.fmt_time(time.time() - time_load))) 
+        except Exception as e: print("animeFace:", path, e); return False 
+        # Batches run under the buffers lock, the old session is closed once the running batch is done. 
+        with self.buffers.lock: 
+            old_sess = self.sess 
+            self.sess, self.net, self.precision = sess, net, precision 
+            if old_sess is not None: old_sess.close() 
         return True 
 
+    def set_batch_size(self, batch_size): 
+        # Applies to the next "All faces". 
+        self.batch_size = batch_size 
+        print("animeFace: batch size", batch_size) 
+
 
     '''
     Plugin destructions 
@@ -109,6 +168,7 @@ class Plugin:
     def close(self): 
         try: self.sess.close() 
         except: pass 
+        self.results.close() 
         print("Plugin closed.") 
 
 
@@ -117,26 +177,44 @@ class Plugin:
     '''
 
     def dump_result(self, result): 
-        for name in result: self.result[name] = result[name] 
-        self.save_json() 
+        # Appends each image's boxes to the result store. 
+        self.results.update(result) 
 
-    def save_json(self): 
-        if len(self.result) < 1: return 
-        try: 
-            fname = os.path.join(os.path.split([name for name in self.result][0])[0], "output.json")
-            with open(fname, "w") as f: json.dump(self.result, f) 
-        except: pass 
+    def detect_image(self, img): 
+        # Detect faces in one image, returns normalized square bboxes with scores. 
+        scores, boxes = self.detect(img)
+        return self._postprocess(img.shape, scores, boxes) 
+
+    def detect_images(self, imgs): 
+        # Batched detect_image. 
+        return [self._postprocess(img.shape, scores, boxes) 
+                for img, (scores, boxes) in zip(imgs, self.detect_batch(imgs))] 
+
+    def _postprocess(self, img_shape, scores, boxes): 
+        boxes = boxes[:, 4:8]
+        scores = scores[:, 1]
+        keep = self.nms(np.hstack([boxes, scores[:, np.newaxis]]).astype(np.float32), self.nms_thresh)
+        boxes = boxes[keep, :]
+        scores = scores[keep]
+        inds = np.where(scores >= self.conf_thresh)[0]
+        scores = scores[inds]
+        boxes = boxes[inds, :]
+
+        result = list()
+        for i in range(scores.shape[0]): 
+            x1, y1, x2, y2 = boxes[i, :].tolist()
+            w = x2 - x1; h = y2 - y1 
+            cx = (x2 + x1) / 2; cy = (y2 + y1) / 2 
+            s = min(w,h) / 2
+            x1 = (cx-s) / img_shape[1]; x2 = (cx+s) / img_shape[1] 
+            y1 = (cy-s) / img_shape[0]; y2 = (cy+s) / img_shape[0]
+            result.append({"score": float(scores[i]), "bbox": [x1,y1,x2,y2]}) 
+        return result 
 
     def try_get_from_json(self, path): 
-        if path not in self.result: 
-            try: 
-                fname = os.path.join(os.path.split(path)[0], "output.json")
-                with open(fname, "r") as f: self.result = json.load(f) 
-            except: pass 
-        if path in self.result: 
-            print("From cache.")
-            return self.result[path] 
-        else: return None 
+        r = self.results.get(path) 
+        if r is not None: print("From cache.") 
+        return r 
 
     '''
     Plugin functions 
@@ -148,96 +226,131 @@ class Plugin:
             return result 
         if paths is None: 
             paths = [self.image_handler.get_path()] 
-        file_len = len(paths)
-        result = dict() 
+        else: 
+            # All faces: the whole directory once scanned, the list of funcs may be older. 
+            self.image_handler.wait_for_scan() 
+            paths = self.image_handler.image_paths 
         self.interface._progress_dialog("Finding face") 
-        for idx, path in enumerate(paths): 
-            try: 
-                path = str(path) 
-                
-                r = self.try_get_from_json(path)
-                if r is not None: 
-                    result[path] = r
-                    continue  
-                
-                img = cv2.imread(path)  
-                scores, boxes = self.detect(img)
-                boxes = boxes[:, 4:8]
-                scores = scores[:, 1]
-                keep = self.nms(np.hstack([boxes, scores[:, np.newaxis]]).astype(np.float32), self.nms_thresh)
-                boxes = boxes[keep, :]
-                scores = scores[keep]
-                inds = np.where(scores >= self.conf_thresh)[0]
-                scores = scores[inds]
-                boxes = boxes[inds, :]
-
-                result[path] = list()
-                for i in range(scores.shape[0]): 
-                    x1, y1, x2, y2 = boxes[i, :].tolist()
-                    w = x2 - x1; h = y2 - y1 
-                    cx = (x2 + x1) / 2; cy = (y2 + y1) / 2 
-                    s = min(w,h) / 2
-                    x1 = (cx-s) / img.shape[1]; x2 = (cx+s) / img.shape[1] 
-                    y1 = (cy-s) / img.shape[0]; y2 = (cy+s) / img.shape[0]
-                    new_result = {"score": float(scores[i]), "bbox": [x1,y1,x2,y2]}
-                    result[path].append(new_result) 
-                self.interface.dialog.progressbar.update_progressbar((idx+1)/(len(paths)))
-            except Exception as e: 
-                print(str(e)) 
-                if "closed Session" in str(e): 
-                    break  
-
-        self.interface.dialog.progressbar.update_progressbar(1.)
-        self.dump_result(result) 
-        return result 
+        return self._predict_all(paths, lambda idx, path: cv2.imread(path), threaded_read=True) 
 
     
     def predictVid(self, all_frames): 
         if all_frames: 
             paths = self.image_handler.image_paths 
         else: 
-            paths = [self.image_handler.get_path()] 
-        file_len = len(paths)
-        result = dict() 
+            paths = self.image_handler.image_paths[self.image_handler.iter-1:self.image_handler.iter] 
         self.interface._progress_dialog("Finding face") 
+        # Frames must be decoded in order on one thread, only preprocessing runs on the pool. 
+        return self._predict_all(paths, lambda idx, path: self.image_handler.get_video_frame(paths.frame(idx)), 
+                                 threaded_read=False) 
+
+
+    def _read_stage(self, pending, read, threaded_read, prepped_q, stop): 
+        # Decodes and preprocesses ahead on the reader pool, in path order. 
+        # An image that cannot be read is passed on as (path, None), so it is still counted. 
+        def load(path, img): 
+            if img is None: raise IOError("Cannot read " + path) 
+            return (path, img.shape) + self._preprocess(img) 
+        def read_load(idx, path): 
+            return load(path, read(idx, path)) 
+        window = self.readers * 2 
+        try: 
+            with ThreadPoolExecutor(max_workers=self.readers) as pool: 
+                futures = deque() 
+                def collect(): 
+                    path, future = futures.popleft() 
+                    try: item = future.result() 
+                    except Exception as e: print(str(e)); item = (path, None) 
+                    stage_queue.put(prepped_q, item, stop) 
+                for idx, path in pending: 
+                    if stop.is_set(): break 
+                    if threaded_read: futures.append((path, pool.submit(read_load, idx, path))) 
+                    else: 
+                        try: img = read(idx, path) 
+                        except Exception as e: print(str(e)); img = None 
+                        futures.append((path, pool.submit(load, path, img))) 
+                    if len(futures) >= window: collect() 
+                while futures: collect() 
+        finally: stage_queue.put(prepped_q, stage_queue.END, stop) 
+
+    def _infer_stage(self, prepped_q, raw_q, stop): 
+        # Keeps the session busy, in batches of up to batch_size. 
+        try: 
+            done = False 
+            while not done and not stop.is_set(): 
+                items = stage_queue.get_batch(prepped_q, self.batch_size, stop) 
+                if items[-1] is stage_queue.END: done = True; items.pop() 
+                failed = [item for item in items if item[1] is None] 
+                items = [item for item in items if item[1] is not None] 
+                raws = list() 
+                if len(items) > 0: 
+                    try: raws = self._infer([(img, img_scale) for _, _, img, img_scale in items]) 
+                    except Exception as e: 
+                        print(str(e)) 
+                        if "closed Session" in str(e): stop.set() 
+                        failed += items; items = list() 
+                for (path, shape, _, img_scale), raw in zip(items, raws): 
+                    stage_queue.put(raw_q, (path, shape, img_scale, raw), stop) 
+                for item in failed: stage_queue.put(raw_q, (item[0], None, None, None), stop) 
+        finally: stage_queue.put(raw_q, stage_queue.END, stop) 
+
+    def _predict_all(self, paths, read, threaded_read=True): 
+        '''
+        Detect faces of all paths with a staged pipeline: 
+
+            readThread      read(idx, path) and preprocessing, on a pool of readers 
+            inferThread     session calls in batches 
+            this thread     bbox decoding, NMS and result writes 
 
+        Stages are joined by bounded queues, so decoding, inference and postprocessing overlap. 
+        '''
+        result = dict() 
+        # Saved results are taken up front, only the other images go through the pipeline and the progressbar. 
+        pending = list() 
         for idx, path in enumerate(paths): 
-            if not all_frames: idx = self.image_handler.iter
-            try: 
-                path = str(path) 
-                
-                r = self.try_get_from_json(path)
-                if r is not None: 
-                    result[path] = r
-                    continue  
-                
-                img = self.image_handler.get_frame(idx) 
-                scores, boxes = self.detect(img) 
-                boxes = boxes[:, 4:8]
-                scores = scores[:, 1]
-                keep = self.nms(np.hstack([boxes, scores[:, np.newaxis]]).astype(np.float32), self.nms_thresh)
-                boxes = boxes[keep, :]
-                scores = scores[keep]
-                inds = np.where(scores >= self.conf_thresh)[0]
-                scores = scores[inds]
-                boxes = boxes[inds, :]
-
-                result[path] = list()
-                for i in range(scores.shape[0]): 
-                    x1, y1, x2, y2 = boxes[i, :].tolist()
-                    w = x2 - x1; h = y2 - y1 
-                    cx = (x2 + x1) / 2; cy = (y2 + y1) / 2 
-                    s = min(w,h) / 2
-                    x1 = (cx-s) / img.shape[1]; x2 = (cx+s) / img.shape[1] 
-                    y1 = (cy-s) / img.shape[0]; y2 = (cy+s) / img.shape[0]
-                    new_result = {"score": float(scores[i]), "bbox": [x1,y1,x2,y2]}
-                    result[path].append(new_result) 
-                self.interface.dialog.progressbar.update_progressbar((idx+1)/(len(paths)))
-            except Exception as e: 
-                print(str(e))  
-                if "closed Session" in str(e): 
-                    break  
+            path = str(path) 
+            r = self.try_get_from_json(path) 
+            if r is not None: result[path] = r 
+            else: pending.append((idx, path)) 
+        stop = threading.Event() 
+        prepped_q = queue.Queue(maxsize=self.batch_size * 2) 
+        raw_q = queue.Queue(maxsize=self.batch_size * 2) 
+        done = 0 
+        detected = 0 
+        last_update = 0 
+        time_start = time.time() 
+
+        read_thread = threading.Thread(target=self._read_stage, name="readThread", daemon=True, 
+                                       args=(pending, read, threaded_read, prepped_q, stop)) 
+        infer_thread = threading.Thread(target=self._infer_stage, name="inferThread", daemon=True, 
+                                        args=(prepped_q, raw_q, stop)) 
+        read_thread.start() 
+        infer_thread.start() 
+        try: 
+            while True: 
+                item = stage_queue.get(raw_q, stop) 
+                if item is stage_queue.END: break 
+                done += 1 
+                path, shape, img_scale, raw = item 
+                if raw is not None: 
+                    try: 
+                        scores, boxes = self._decode(*raw, img_scale, shape) 
+                        result[path] = self._postprocess(shape, scores, boxes) 
+                        self.dump_result({path: result[path]}) 
+                        detected += 1 
+                    except Exception as e: print(str(e)) 
+                if time.time() - last_update >= self.progress_interval: 
+                    self.interface.dialog.progressbar.update_progressbar(done/len(pending)) 
+                    last_update = time.time() 
+        finally: 
+            stop.set() 
+            read_thread.join() 
+            infer_thread.join() 
 
+        elapsed = time.time() - time_start 
         self.interface.dialog.progressbar.update_progressbar(1.)
-        self.dump_result(result) 
+        if detected > 0: 
+            report = "{:.2f} images/sec, batch size {}".format(detected / elapsed, self.batch_size) 
+            print("Detected {} images in {}, {}.".format(detected, self.fmt_time(elapsed), report)) 
+            if len(paths) > 1: self.interface._info_dialog(report) 
         return result 
@@ -0,0 +1,66 @@
+import cv2
+import threading
+import numpy as np
+from collections import OrderedDict
+
+'''
+Faster-RCNN input preprocessing.
+The uint8 image is resized first (short side 600, long side at most 1000),
+and the mean pixel is subtracted while writing into a preallocated float32
+batch buffer, so no float copy of the full resolution image is made.
+Buffers are kept per padded batch shape, the most recent `capacity`
+shapes are reused. Hold `lock` from `fill` until the batch was fed.
+
+'''
+
+PIXEL_MEANS = np.array([102.9801, 115.9465, 112.7717], dtype=np.float32)
+
+
+def rescale(image, target_size=600, max_size=1000):
+    # Returns the resized uint8 image and its scale.
+    img_size_min = np.min(image.shape[:2])
+    img_size_max = np.max(image.shape[:2])
+    img_scale = target_size / img_size_min
+    if np.round(img_scale * img_size_max) > max_size:
+        img_scale = max_size / img_size_max
+    img = cv2.resize(image, None, None, img_scale, img_scale, cv2.INTER_LINEAR)
+    return img, img_scale
+
+
+class BatchBuffer:
+    def __init__(self, capacity=8):
+        self.capacity = capacity
+        self.buffers = OrderedDict()   # {(height, width): float32 array}
+        self.lock = threading.Lock()
+
+    def _buffer(self, n, height, width):
+        buffer = self.buffers.pop((height, width), None)
+        if buffer is None or len(buffer) < n:
+            buffer = np.empty((n, height, width, 3), dtype=np.float32)
+        self.buffers[(height, width)] = buffer
+        while len(self.buffers) > self.capacity: self.buffers.popitem(last=False)
+        return buffer[:n]
+
+    def fill(self, prepped):
+        '''
+        Arguments:
+        ------------
+            prepped: list
+                [(img, img_scale), ...] of `rescale` outputs.
+        ------------
+        Returns the zero padded, mean subtracted batch and its im_info.
+        The batch is overwritten by the next `fill` of the same shape.
+
+        '''
+        height = max(img.shape[0] for img, _ in prepped)
+        width = max(img.shape[1] for img, _ in prepped)
+        batch = self._buffer(len(prepped), height, width)
+        img_info = np.empty((len(prepped), 3), dtype=np.float32)
+        for j, (img, img_scale) in enumerate(prepped):
+            h, w = img.shape[:2]
+            np.subtract(img, PIXEL_MEANS, out=batch[j, :h, :w])
+            # Zero padding is the mean pixel after mean subtraction.
+            batch[j, h:] = 0
+            batch[j, :h, w:] = 0
+            img_info[j] = (h, w, img_scale)
+        return batch, img_info
@@ -0,0 +1,148 @@
+import numpy as np
+import tensorflow as tf
+import argparse
+import os
+import cv2
+import tempfile
+import time
+from preprocess import rescale, BatchBuffer
+from frozen_graph import INPUTS, OUTPUTS, FROZEN_GRAPH, FrozenRCNN, read_graph_def, resolve_model
+
+'''
+Reduced precision variants of the frozen graph, quantized inside
+TensorFlow with graph_transforms (TF-Lite cannot convert the batched
+graph, the proposal loop is v1 control flow).
+
+    float      the frozen graph of frozen_graph.py
+    weights    conv and fc weights stored in 8 bits and turned back into
+               float when the graph is loaded: a 4x smaller file, the
+               compute stays float
+    eight_bit  8 bit weights and activations (QuantizedConv2D, ...), the
+               activation ranges are calibrated on images of a directory
+
+Calibration runs the quantized graph with every RequantizationRange
+logged, and freezes the logged min/max into constants. The ranges inside
+the proposal loop cannot be frozen (constants would leave the loop
+frame), they stay computed on every run. `frozen_graph.load` loads any
+of the variants, see benchmark_precision.py for their speed and
+accuracy.
+
+    python frozen_graph.py
+    python quantized_graph.py -precision weights
+    python quantized_graph.py -precision eight_bit -calib /path/to/images
+
+'''
+
+PRECISIONS = ('float', 'weights', 'eight_bit')
+# Per channel vectors stay float: they are small, and a constant vector (e.g. all zero
+# biases) has an empty 8 bit range, which dequantizes to NaN.
+MIN_WEIGHT_SIZE = 4096
+
+
+def precision_path(model_dir, precision):
+    if precision == 'float': return resolve_model(model_dir)
+    return os.path.join(model_dir, FROZEN_GRAPH.replace('.pb', '_%s.pb' % precision))
+
+
+def available(model_dir):
+    # Precisions which have a model in model_dir, float always (the checkpoint at least).
+    return ['float'] + [precision for precision in PRECISIONS[1:]
+                        if os.path.exists(precision_path(model_dir, precision))]
+
+
+def calibration_images(calib_dir, n=100):
+    # (batch, img_info) of `n` images of calib_dir, evenly spread over the sorted file list.
+    files = sorted(os.path.join(root, name) for root, _, names in os.walk(calib_dir) for name in names
+                   if name.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.webp')))
+    if len(files) > n: files = [files[i] for i in np.linspace(0, len(files) - 1, n).astype(int)]
+    buffers = BatchBuffer()
+    for file in files:
+        image = cv2.imread(file)
+        if image is not None: yield buffers.fill([rescale(image)])
+
+
+def _log_ranges(graph_def, images, log_path):
+    # Runs the graph with the requantization ranges printed. Print ops log to the
+    # stderr file descriptor from C++, which is redirected to log_path meanwhile.
+    from tensorflow.tools.graph_transforms import TransformGraph
+    graph_def = TransformGraph(graph_def, INPUTS, OUTPUTS, [
+        'insert_logging(op=RequantizationRange, show_name=true, message="__requant_min_max:")'])
+    net = FrozenRCNN(None, graph_def)
+    count = 0
+    stderr = os.dup(2)
+    with open(log_path, 'w') as log, tf.Session(graph=net.graph) as sess:
+        os.dup2(log.fileno(), 2)
+        try:
+            for batch, img_info in images:
+                net.test_image(sess, batch, img_info)
+                count += 1
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+    return count
+
+
+def _freeze_ranges(graph_def, log_path):
+    # Only the ranges outside of the proposal loop, see the module description.
+    with open(log_path) as f: lines = [line for line in f if '__requant_min_max:' in line and '/while/' not in line]
+    with open(log_path, 'w') as f: f.writelines(lines)
+    from tensorflow.tools.graph_transforms import TransformGraph
+    return TransformGraph(graph_def, INPUTS, OUTPUTS, [
+        'freeze_requantization_ranges(min_max_log_file="%s")' % log_path.replace('\\', '/')])
+
+
+def quantize(frozen, output, precision='weights', calib_dir=None, n=100):
+    '''
+    Arguments:
+    ------------
+        frozen: str
+            The frozen graph of frozen_graph.py.
+        output: str
+            The quantized graph path.
+        precision: str
+            "weights" or "eight_bit".
+        calib_dir: str
+            Calibration image directory, needed by "eight_bit".
+        n: int
+            Number of calibration images.
+
+    '''
+    assert precision in PRECISIONS[1:], 'Unknown precision ' + precision
+    assert precision != 'eight_bit' or calib_dir is not None, 'eight_bit quantization needs a calibration directory'
+    from tensorflow.tools.graph_transforms import TransformGraph
+    transforms = ['quantize_weights(minimum_size=%d)' % MIN_WEIGHT_SIZE]
+    if precision == 'eight_bit': transforms.append('quantize_nodes')
+    graph_def = TransformGraph(read_graph_def(frozen), INPUTS, OUTPUTS, transforms)
+    if precision == 'eight_bit':
+        fd, log_path = tempfile.mkstemp(suffix='.txt')
+        os.close(fd)
+        try:
+            time_start = time.time()
+            count = _log_ranges(graph_def, calibration_images(calib_dir, n), log_path)
+            assert count > 0, 'No calibration image in ' + calib_dir
+            print('Calibrated on %d images in %.1f s.' % (count, time.time() - time_start))
+            graph_def = _freeze_ranges(graph_def, log_path)
+        finally: os.remove(log_path)
+    with tf.gfile.GFile(output, 'wb') as f: f.write(graph_def.SerializeToString())
+    print('%d nodes, %.1f MB written to %s' % (len(graph_def.node), os.path.getsize(output) / 2**20, output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quantize the frozen graph of the anime face detector')
+    parser.add_argument('-frozen', help='The frozen graph of frozen_graph.py', dest='frozen', type=str,
+                        default=os.path.join('model', FROZEN_GRAPH))
+    parser.add_argument('-precision', help='Quantization', choices=PRECISIONS[1:], dest='precision',
+                        default='weights')
+    parser.add_argument('-calib', help='Calibration image directory (eight_bit)', dest='calib', type=str)
+    parser.add_argument('-n', help='Number of calibration images', dest='n', default=100, type=int)
+    args = parser.parse_args()
+
+    assert os.path.exists(args.frozen), 'Export the frozen graph first: python frozen_graph.py'
+    time_start = time.time()
+    quantize(args.frozen, precision_path(os.path.dirname(args.frozen), args.precision), args.precision,
+             args.calib, args.n)
+    print('Quantized in %.1f s.' % (time.time() - time_start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import os
+import sys
+import cv2
+import queue
+import argparse
+import threading
+import numpy as np
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+from image_crop import ImageHandler
+from Tools.crop_engine import CropEngine
+from Tools.crop_manifest import CropManifest
+from Tools.shard_writer import make_sink, SINKS
+from Tools import stage_queue
+
+'''
+Headless batch pipeline: scan -> detect -> crop, without the OpenCV GUI.
+Reuses ImageHandler for directory scanning / video frames, the detector
+plugins, and the Crop_Tool padding logic (via CropEngine). The three
+stages run concurrently with bounded queues in between:
+
+    load    reader threads decode images (or the video, in frame order)
+    detect  one thread runs the detector plugin
+    crop    worker threads apply padding, crop and write to the output sink
+
+Example:
+    python batch_crop.py -i /path/to/images -detector lbpcascade_animeface -padding 0.2 0.3 0.2 0.1 -mode tar
+
+'''
+
+DETECTORS = ("animeFace", "lbpcascade_animeface")
+_DONE = stage_queue.END
+
+
+def load_detector(name, image_handler, base):
+    # Same import as Plugins.importPlugin, without an Interface.
+    if base not in sys.path: sys.path.append(base)
+    sys.path.append(os.path.join(base, name))
+    if name == "animeFace":
+        import animeFace.plugin
+        plugin = animeFace.plugin.Plugin(None, image_handler)
+    else:
+        import lbpcascade_animeface.plugin
+        plugin = lbpcascade_animeface.plugin.Plugin(None, image_handler)
+    plugin.name = name
+    if not plugin.load(base): raise RuntimeError("Cannot load plugin " + name)
+    return plugin
+
+
+class Pipeline:
+    '''
+    Pipeline initializations.
+    '''
+
+    def __init__(self, image_handler, plugin, engine, manifest=None, readers=4, queue_size=32):
+        self.image_handler = image_handler
+        self.plugin = plugin
+        self.engine = engine
+        self.manifest = manifest
+        self.readers = readers
+        self.loaded = queue.Queue(maxsize=queue_size)
+        self.detected = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.written = 0
+        self.skipped = 0
+        self.errors = 0
+        self.progress = None
+        self._lock = threading.Lock()
+        # Video frames are keyed by the video file, images by themselves.
+        video_mtime = os.stat(str(image_handler.path)).st_mtime if image_handler.is_video_mode() else None
+        self._mtime = (lambda path: video_mtime) if video_mtime is not None else CropEngine._mtime
+
+    def _put(self, q, item):
+        stage_queue.put(q, item, self.stop)
+
+    def _get(self, q):
+        return stage_queue.get(q, self.stop)
+
+    def _error(self, *message):
+        print(*message)
+        with self._lock: self.errors += 1
+        self.progress.update(1)
+
+
+    '''
+    Pipeline stages.
+    '''
+
+    def _load_images(self):
+        def read(path): return path, cv2.imread(path)
+        paths = self.image_handler.image_paths
+        with ThreadPoolExecutor(max_workers=self.readers) as pool:
+            futures = list()
+            for path in paths:   # Waits for the paths the scan has not found yet.
+                if self.stop.is_set(): break
+                futures.append(pool.submit(read, str(path)))
+                if len(futures) >= self.readers * 2: self._put(self.loaded, futures.pop(0).result())
+            for future in futures: self._put(self.loaded, future.result())
+
+    def _load_video(self):
+        frames = self.image_handler.image_paths
+        for i in range(len(frames)):
+            if self.stop.is_set(): break
+            self._put(self.loaded, (frames[i], self.image_handler.get_frame(i)))
+
+    def _load(self):
+        try:
+            if self.image_handler.is_video_mode(): self._load_video()
+            else: self._load_images()
+        finally:
+            # Every image was loaded only if the scan is over, which also gives the real total.
+            if not self.stop.is_set():
+                self.progress.total = self.image_handler.wait_for_scan()
+                self.progress.refresh()
+            self._put(self.loaded, _DONE)
+
+    def _detect_one(self, path, img):
+        boxes = self.plugin.try_get_from_json(path)
+        if boxes is None:
+            boxes = self.plugin.detect_image(img)
+            self.plugin.dump_result({path: boxes})   # Appended to the result store right away.
+        return boxes
+
+    def _detect(self):
+        try:
+            while True:
+                item = self._get(self.loaded)
+                if item is _DONE: break
+                path, img = item
+                if img is None: self._error("Cannot read", path); continue
+                try: boxes = self._detect_one(path, img)
+                except Exception as e: self._error("Cannot detect", path, e); continue
+                self._put(self.detected, (path, img, boxes))
+        except BaseException:
+            self.stop.set()   # Nothing would feed the crop workers any more.
+            raise
+        finally:
+            for _ in range(self.engine.workers): self._put(self.detected, _DONE)
+
+    def _crop_one(self, path, img, boxes):
+        if len(boxes) == 0: return
+        boxes = np.asarray([box["bbox"] for box in boxes], dtype=np.float32)
+        mtime = self._mtime(path)
+        if self.manifest is not None and self.manifest.is_done(path, mtime, self.engine.padding, boxes):
+            with self._lock: self.skipped += 1
+            return
+        n = self.engine.crop_one(path, boxes, img)
+        with self._lock: self.written += n
+        self.engine.record(path, mtime, boxes, n)   # Once the sink has saved the crops.
+
+    def _crop(self):
+        while True:
+            item = self._get(self.detected)
+            if item is _DONE: break
+            try: self._crop_one(*item)
+            except Exception as e: self._error(e); continue
+            self.progress.update(1)
+
+
+    '''
+    Pipeline RUN function.
+    '''
+
+    def run(self):
+        self.progress = tqdm(total=len(self.image_handler.image_paths), unit="img")
+        threads = [threading.Thread(target=self._load, name="loadThread", daemon=True),
+                   threading.Thread(target=self._detect, name="detectThread", daemon=True)]
+        threads += [threading.Thread(target=self._crop, name="cropThread", daemon=True)
+                    for _ in range(self.engine.workers)]
+        for thread in threads: thread.start()
+        try: self._join(threads)
+        except KeyboardInterrupt:
+            print("Stopping.")
+            self.stop.set()
+            # The crop workers may still be writing, wait for them before the sink is closed.
+            self._join(threads)
+        self.progress.close()
+        return self.written
+
+    @staticmethod
+    def _join(threads):
+        for thread in threads:
+            while thread.is_alive(): thread.join(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless face detection and crop pipeline")
+    parser.add_argument("-i", help="The input image directory or video", required=True, dest="input", type=str)
+    parser.add_argument("-detector", help="Detector plugin", choices=DETECTORS, dest="detector",
+                        default="lbpcascade_animeface")
+    parser.add_argument("-padding", help="Padding ratios of the bbox size: left top right bottom", nargs=4,
+                        dest="padding", type=float, default=[0., 0., 0., 0.])
+    parser.add_argument("-mode", help="Output mode", choices=sorted(SINKS), dest="mode", default="files")
+    parser.add_argument("-max_side", help="Longest image side detection runs at (lbpcascade_animeface), default "
+                        "full resolution. 1024 was 1.25x faster with the same faces on the 1200px samples, but "
+                        "missed faces upscaled 2x and 3x; run lbpcascade_animeface/resolution_report.py on "
+                        "your images", dest="max_side", type=int, default=None)
+    parser.add_argument("-interval", help="Frame interval (video)", dest="interval", type=int, default=1)
+    parser.add_argument("-readers", help="Image reader threads", dest="readers", type=int, default=4)
+    parser.add_argument("-workers", help="Crop worker threads", dest="workers", type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument("-queue", help="Queue size between stages", dest="queue_size", type=int, default=32)
+    args = parser.parse_args()
+
+    assert os.path.exists(args.input), "The input path does not exists"
+    base = os.path.dirname(os.path.abspath(__file__))
+
+    image_handler = ImageHandler()
+    image_handler.load_from_directory(args.input, restore_checkpoint=False)
+    if image_handler.is_video_mode() and args.interval > 1: image_handler.set_frame_interval(args.interval)
+    plugin = load_detector(args.detector, image_handler, base)
+    if args.max_side: plugin.set_max_side(args.max_side)
+
+    root = args.input if not image_handler.is_video_mode() else os.path.split(args.input)[0]
+    sink = make_sink(args.mode)
+    manifest = CropManifest(os.path.join(root, "Output", "_manifest.jsonl"), sink.settings)
+    engine = CropEngine(tuple(args.padding), workers=args.workers, write=sink.write, manifest=manifest,
+                        saved=sink.on_saved)
+    pipeline = Pipeline(image_handler, plugin, engine, manifest, args.readers, args.queue_size)
+    try: pipeline.run()
+    finally:
+        sink.close()
+        manifest.close()
+        plugin.close()
+        image_handler.close()
+    print("{} crops written, {} images skipped, {} errors.".format(pipeline.written, pipeline.skipped, pipeline.errors))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,22 @@ import math
 import pathlib 
 import threading
 import numpy as np 
+from concurrent.futures import ThreadPoolExecutor 
 from tqdm import tqdm
-from time import time 
-from tkinter import Tk
+from time import time, sleep 
 
 # Tools 
 from Tools import remove_similar_images as rm_sim_imgs 
+from Tools.image_cache import ImageCache 
+from Tools.image_probe import image_size 
+from Tools.directory_scanner import DirectoryScanner, PathTable, DEFAULT_EXTENSIONS 
+from Tools.video_source import VideoFrameSource, FrameList 
+from Tools.crop_writer import CropWriter 
+from Tools.crop_engine import CropEngine 
+from Tools.box_store import BoxStore, padded_box 
+from Tools.crop_manifest import CropManifest 
+from Tools.result_store import ResultStore 
+from Tools.shard_writer import make_sink 
 
 
 endFlag = False 
@@ -34,31 +44,101 @@ class Thread (threading.Thread):
 
 
 class BuiltIns: 
-    def __init__(self): 
+    def __init__(self, cell_size=50): 
         self.button_list = list() 
+        self.cell_size = cell_size 
+        self._grid = None    # {(cell_x, cell_y): [buttons, top-most first]} 
+        self._lookup = None  # Last resolved (x, y, button). 
 
     def register_button(self, button): 
         self.button_list.append(button) 
+        self.invalidate_index() 
+
+    def invalidate_index(self): 
+        # Called when buttons register, unregister or change zIndex. 
+        self._grid = None 
+        self._lookup = None 
+
+    def _build_index(self): 
+        grid = dict() 
+        cs = self.cell_size 
+        # Stable sort keeps registration order among buttons on the same layer. 
+        for button in sorted(list(self.button_list), key=lambda i:i.zIndex, reverse=True): 
+            for cx in range(button.pt1[0] // cs, button.pt2[0] // cs + 1): 
+                for cy in range(button.pt1[1] // cs, button.pt2[1] // cs + 1): 
+                    grid.setdefault((cx, cy), list()).append(button) 
+        self._grid = grid 
+        return grid 
+
+    def top_button(self, x, y): 
+        lookup = self._lookup 
+        if lookup is not None and lookup[0] == x and lookup[1] == y: return lookup[2] 
+        grid = self._grid 
+        if grid is None: grid = self._build_index() 
+        top = None 
+        for button in grid.get((x // self.cell_size, y // self.cell_size), ()): 
+            if x > button.pt1[0] and x < button.pt2[0] and \
+               y > button.pt1[1] and y < button.pt2[1]: 
+                top = button; break 
+        self._lookup = (x, y, top) 
+        return top 
     
     def mouse_event_button(self, button, x, y, click): 
-        mouse_buttons = list() 
-        for registered_button in self.button_list: 
-            if x > registered_button.pt1[0] and x < registered_button.pt2[0] and \
-               y > registered_button.pt1[1] and y < registered_button.pt2[1]: 
-                mouse_buttons.append(registered_button) 
-        mouse_buttons = sorted(mouse_buttons, key=lambda i:i.zIndex, reverse=True) 
-        if mouse_buttons[0].text == button.text: return True 
+        top = self.top_button(x, y) 
+        if top is not None and top.text == button.text: return True 
         elif not click: return True
         else: return False 
 
     def unregister_button(self, button): 
-        for i, registered_button in enumerate(self.button_list): 
-            if registered_button.text == button.text: 
-                self.button_list.pop(i)
+        self.button_list = [registered_button for registered_button in self.button_list 
+                            if registered_button.text != button.text] 
+        self.invalidate_index() 
 
 __buildins__ = BuiltIns() 
 
 
+class RenderScheduler: 
+    '''
+    Decide when the window needs to be redrawn. 
+
+    Anything that changes what is on screen (mouse, key, progress, new image) 
+    calls `invalidate`. The refresh loop then redraws at most `max_fps` times 
+    per second, and only `idle_fps` times per second when nothing is dirty. 
+    Set `idle_fps` to 0 to stop redrawing entirely while idle. 
+
+    '''
+
+    def __init__(self, max_fps=30, idle_fps=1): 
+        self.max_fps = max_fps 
+        self.idle_fps = idle_fps 
+        self.frames_rendered = 0 
+        self.frames_skipped = 0 
+        self._dirty = threading.Event() 
+        self._dirty.set() 
+        self._last_frame = 0. 
+
+    def invalidate(self): 
+        # Requests arriving while a frame is already pending are merged into it. 
+        if self._dirty.is_set(): self.frames_skipped += 1 
+        else: self._dirty.set() 
+
+    def wait_frame(self): 
+        timeout = 1. / self.idle_fps if self.idle_fps > 0 else 0.5 
+        if not self._dirty.wait(timeout) and self.idle_fps <= 0: 
+            return False  # Idle, nothing to draw. 
+        delay = self._last_frame + 1. / self.max_fps - time() 
+        if delay > 0: sleep(delay) 
+        self._dirty.clear() 
+        self._last_frame = time() 
+        self.frames_rendered += 1 
+        return True 
+
+    def get_formatted_info(self): 
+        return "{} frames rendered, {} frames skipped".format(self.frames_rendered, self.frames_skipped) 
+
+__scheduler__ = RenderScheduler() 
+
+
 class Button: 
     OnHover = 1
     OnClick = 2 
@@ -77,6 +157,17 @@ class Button:
         self.zIndex = zIndex 
         self.mouseHandler = mouseHandler 
         __buildins__.register_button(self) 
+
+    @property 
+    def zIndex(self): 
+        return self._zIndex 
+
+    @zIndex.setter 
+    def zIndex(self, zIndex): 
+        global __buildins__ 
+        if getattr(self, "_zIndex", None) != zIndex: 
+            self._zIndex = zIndex 
+            __buildins__.invalidate_index() 
         
     def update_status(self): 
         global __buildins__ 
@@ -183,14 +274,23 @@ class MenuTree:
                 for button in self.tree[parentName]["child"]: 
                     button.zIndex = -1 
     
-    def construct_menu_tree(self, mat): 
+    def _construct_bar(self, mat): 
         cv2.rectangle(mat, (0,0), (self.winWidth, self.parentHeight), self.color, -1)
+        cv2.line(mat, (0,self.parentHeight), (self.winWidth, self.parentHeight), (100,100,100), 1) 
+
+    def widgets(self): 
+        # Drawing order of the menu, as (key, pt1, pt2, draw) for the Compositor. 
+        widgets = [(("MenuTree",), (0,0), (self.winWidth, self.parentHeight), self._construct_bar)] 
         for parentName in self.tree: 
-            self.tree[parentName]["parent"].construct_button(mat) 
+            button = self.tree[parentName]["parent"] 
+            widgets.append(((button.text, button.status), button.pt1, button.pt2, button.construct_button)) 
             if self.tree[parentName]["hidden"] is False: 
                 for button in self.tree[parentName]["child"]: 
-                    button.construct_button(mat) 
-        cv2.line(mat, (0,self.parentHeight), (self.winWidth, self.parentHeight), (100,100,100), 1) 
+                    widgets.append(((button.text, button.status), button.pt1, button.pt2, button.construct_button)) 
+        return widgets 
+
+    def construct_menu_tree(self, mat): 
+        for _, _, _, draw in self.widgets(): draw(mat) 
 
 
 class ProgressBar: 
@@ -235,9 +335,11 @@ class ProgressBar:
         cv2.putText(mat, s, (self.pt1[0], self.pt1[1]-3), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (200,200,200), 1)
 
     def update_progressbar(self, progress): 
+        global __scheduler__ 
         self.progress = progress 
         duration = time() - self.starttime 
         self.eta = self.fmt_time((1.-self.progress) * duration / self.progress) 
+        __scheduler__.invalidate() 
 
 
 class Textbox: 
@@ -271,6 +373,7 @@ class Textbox:
         self.keyHandler.set_inputting(False) 
 
     def _input_from_clipboard(self): 
+        from tkinter import Tk  # Needs a display, import only when used. 
         self.keyHandler.string_value = Tk().clipboard_get()
         self.onFocus = True 
         self.button.onFocus = True 
@@ -291,16 +394,23 @@ class Notifier:
         text = text 
         self.notifiers.append({"pt1": pt1, "pt2": pt2, "title": title, "text": text, "color": (0,0,0)})
     
+    def _construct_notifier(self, mat, notifier): 
+        cv2.rectangle(mat, notifier["pt1"], notifier["pt2"], notifier["color"], -1) 
+        cv2.rectangle(mat, notifier["pt1"], notifier["pt2"], (255,255,255), 1) 
+        cv2.putText(mat, notifier["title"], (notifier["pt1"][0]+ 10, notifier["pt1"][1] + 30), 
+                    cv2.FONT_HERSHEY_DUPLEX, 0.75, (255,255,255), 1)
+        cv2.putText(mat, notifier["text"], (notifier["pt1"][0]+ 10, notifier["pt1"][1] + 60), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,255,255), 1)
+        cv2.putText(mat, "Click on this balloon to close.", (notifier["pt1"][0]+ 10, notifier["pt2"][1] - 12), 
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200,200,200), 1)
+
+    def widgets(self): 
+        return [((notifier["title"], notifier["text"], notifier["color"]), notifier["pt1"], notifier["pt2"], 
+                 lambda mat, notifier=notifier: self._construct_notifier(mat, notifier)) 
+                for notifier in self.notifiers] 
+
     def construct_notifiers(self, mat): 
-        for notifier in self.notifiers: 
-            cv2.rectangle(mat, notifier["pt1"], notifier["pt2"], notifier["color"], -1) 
-            cv2.rectangle(mat, notifier["pt1"], notifier["pt2"], (255,255,255), 1) 
-            cv2.putText(mat, notifier["title"], (notifier["pt1"][0]+ 10, notifier["pt1"][1] + 30), 
-                        cv2.FONT_HERSHEY_DUPLEX, 0.75, (255,255,255), 1)
-            cv2.putText(mat, notifier["text"], (notifier["pt1"][0]+ 10, notifier["pt1"][1] + 60), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255,255,255), 1)
-            cv2.putText(mat, "Click on this balloon to close.", (notifier["pt1"][0]+ 10, notifier["pt2"][1] - 12), 
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200,200,200), 1)
+        for notifier in self.notifiers: self._construct_notifier(mat, notifier) 
     
     def update_status(self, x, y, click=False):  
         for i, notifier in enumerate(self.notifiers): 
@@ -311,6 +421,79 @@ class Notifier:
             else: self.notifiers[i]["color"] = (0,0,0) 
 
 
+class Compositor: 
+    '''
+    Cached layer compositing for the window. 
+
+    The base layer (background, current image and path info) and the chrome 
+    layer (buttons, menu tree and notifiers) are rendered into cached buffers. 
+    Each frame copies the base layer into a preallocated frame buffer and 
+    blits the chrome widgets on top, one region per widget. A widget is only 
+    redrawn into the chrome layer when its key (e.g. hover status) changes. 
+
+    '''
+
+    def __init__(self, size, background=27): 
+        self.size = size 
+        self.background = background 
+        self.frame = np.empty((size, size, 3), dtype=np.uint8) 
+        self.base = np.full((size, size, 3), background, dtype=np.uint8) 
+        self.chrome = np.zeros((size, size, 3), dtype=np.uint8) 
+        self._base_img = None 
+        self._base_text = None 
+        self._widgets = list() 
+
+    def _region(self, pt1, pt2): 
+        # Rectangles are drawn inclusive of pt2. 
+        return (max(pt1[0], 0), max(pt1[1], 0), min(pt2[0]+1, self.size), min(pt2[1]+1, self.size)) 
+
+    def update_base(self, img, org, text): 
+        if img is self._base_img and text == self._base_text: return 
+        self.base[:] = self.background 
+        if img is not None: 
+            try: self.base[org[1]:org[1]+img.shape[0], org[0]:org[0]+img.shape[1]] = img 
+            except: pass 
+        if text is not None: 
+            cv2.putText(self.base, text, (3, self.size-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (100,100,100), 1) 
+        self._base_img = img 
+        self._base_text = text 
+
+    def update_chrome(self, widgets): 
+        '''
+        Arguments: 
+        ------------
+            widgets: list 
+                (key, pt1, pt2, draw) for each widget, in drawing order. 
+                `draw(mat)` renders the widget into `mat`. 
+        ------------
+
+        '''
+        regions = [self._region(pt1, pt2) for _, pt1, pt2, _ in widgets] 
+        if regions != [region for _, region in self._widgets]: 
+            # Widgets appeared or disappeared, rebuild the whole layer. 
+            for _, _, _, draw in widgets: draw(self.chrome) 
+        else: 
+            dirty = list() 
+            for i, (key, _, _, draw) in enumerate(widgets): 
+                # Also redraw widgets stacked on top of a redrawn one. 
+                if key != self._widgets[i][0] or any(self._overlap(regions[i], r) for r in dirty): 
+                    draw(self.chrome) 
+                    dirty.append(regions[i]) 
+        self._widgets = [(widget[0], region) for widget, region in zip(widgets, regions)] 
+
+    @staticmethod 
+    def _overlap(a, b): 
+        return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3] 
+
+    def compose(self): 
+        np.copyto(self.frame, self.base) 
+        return self.frame 
+
+    def blit_chrome(self): 
+        for _, (x1, y1, x2, y2) in self._widgets: 
+            self.frame[y1:y2, x1:x2] = self.chrome[y1:y2, x1:x2] 
+
+
 class Dialog: 
     INFO = 0 
     # YESNO = 1 
@@ -402,9 +585,11 @@ class MouseHandler:
         self.click = False 
 
     def onMouseHandle(self, event, x, y, flags, param): 
+        global __scheduler__ 
         self.x = x; self.y = y 
         if event == cv2.EVENT_LBUTTONDOWN: self.click = True 
         elif event == cv2.EVENT_LBUTTONUP: self.click = False 
+        __scheduler__.invalidate() 
 
 
 class KeyHandler: 
@@ -419,7 +604,9 @@ class KeyHandler:
         self.args[key] = args
 
     def handle_key(self, timeout): 
+        global __scheduler__ 
         key = cv2.waitKey(timeout) 
+        if key != -1: __scheduler__.invalidate() 
         if not self.inputting: 
             for k in self.keys: 
                 if key == k: 
@@ -440,103 +627,146 @@ class KeyHandler:
 
 
 class ImageHandler: 
-    def __init__(self): 
+    def __init__(self, prefetch_ahead=4, prefetch_behind=2, cache_bytes=256*1024*1024, prefetch_workers=2, 
+                 extensions=DEFAULT_EXTENSIONS): 
         self.image_paths = None 
+        self.extensions = extensions 
+        self.scanner = None 
+        self.video = None 
         self.path = None 
         self.iter = 0 
         self.interval = 1 
         self.deleted = 0 
         self.img = None 
+        self.prefetch_ahead = prefetch_ahead 
+        self.prefetch_behind = prefetch_behind 
+        self.cache = ImageCache(self._read_resized, cache_bytes, prefetch_workers) 
 
-    def load_from_directory(self, dir_path, interface=None): 
+    def load_from_directory(self, dir_path, interface=None, restore_checkpoint=True): 
         self.interface = interface 
+        self.cache.clear() 
         self.path = pathlib.Path(dir_path) 
         if not os.path.isdir(dir_path): # Video mode. 
             self._video_mode = True 
-            self.cap = cv2.VideoCapture(dir_path) 
-            length = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)) 
-            self.image_paths = [f"{dir_path}-{i}" for i in range(length)] 
+            if self.video is not None: self.video.close() 
+            self.video = VideoFrameSource(dir_path) 
+            length = self.video.length 
+            self.image_paths = FrameList(dir_path, range(length)) 
         else: # Image directory mode. 
             self._video_mode = False 
-            self.image_paths = list(self.path.glob("*.jpg"))  
-            for path in list(self.path.glob("*.png")): self.image_paths.append(path) 
-            print(f"{len(self.image_paths)} images found.") 
+            # Scan in background, the first images are shown before the scan completes. 
+            if self.scanner is not None: self.scanner.stop() 
+            self.scanner = DirectoryScanner(dir_path, self.extensions).start() 
+            self.image_paths = self.scanner.paths 
             # Restore iter from file. 
-            if os.path.exists(os.path.join(dir_path, "_iter.txt")): 
+            if restore_checkpoint and os.path.exists(os.path.join(dir_path, "_iter.txt")): 
                 with open(os.path.join(dir_path, "_iter.txt"), "r") as f: 
                     self.iter = int(f.read()) - 1
-                    if self.iter >= len(self.image_paths): 
+                    if self.scanner.wait_for(self.iter + 1) <= self.iter: 
                         self.iter = 0 
                         self._check_square(interface) 
 
-    def _check_square(self, interface=None): 
+    def _check_square_one(self, path): 
+        # Returns True if the image should be removed from the list. 
+        try: 
+            img = None 
+            size = image_size(path) 
+            if size is None: # Unknown header, decode fully. 
+                img = cv2.imread(str(path)) 
+                size = (img.shape[1], img.shape[0]) 
+            width, height = size 
+            if abs(width / height - 1) < 0.1: 
+                if width != height: 
+                    if img is None: img = cv2.imread(str(path)) 
+                    s = max(img.shape[1], img.shape[0]) 
+                    cv2.imwrite(str(path), cv2.resize(img, (s,s))) 
+                return True 
+        except Exception as e: 
+            print(e, str(path)) 
+            return True 
+        return False 
+
+    def _check_square(self, interface=None, workers=8): 
         print("Final checking...") 
         remove_list = list() 
-        for i, path in tqdm(enumerate(self.image_paths)): 
-            if interface is not None: 
-                interface.dialog.progressbar.update_progressbar(i/(len(self.image_paths)-1))
-            try: 
-                img = cv2.imread(str(path)) 
-                width = img.shape[1]; height = img.shape[0] 
-                if abs(width / height - 1) < 0.1: 
-                    remove_list.append(i)
-                    if width != height: 
-                        s = max(width, height) 
-                        cv2.imwrite(str(path), cv2.resize(img, (s,s))) 
-            except Exception as e: 
-                print(e, str(path)) 
-                remove_list.append(i)
-        remove_list = sorted(remove_list, reverse=True) 
-        for i in remove_list: self.image_paths.pop(i) 
+        with ThreadPoolExecutor(max_workers=workers) as pool: 
+            results = pool.map(self._check_square_one, self.image_paths) 
+            for i, remove in tqdm(enumerate(results)): 
+                if interface is not None: 
+                    interface.dialog.progressbar.update_progressbar(i/(len(self.image_paths)-1))
+                if remove: remove_list.append(i) 
+        remove_list = set(remove_list) 
+        self.image_paths = PathTable(path for i, path in enumerate(self.image_paths) if i not in remove_list) 
         print(f"After final check: {len(self.image_paths)} images.") 
 
     def get_path(self): 
         return str(self.image_paths[self.iter-1]) 
 
     def get_formatted_info(self): 
-        return "[{}/{}] {}".format(self.iter, len(self.image_paths), self.get_path()) 
+        scanning = "" if self.is_video_mode() or self.scanner.done.is_set() else "+" 
+        return "[{}/{}{}] {}".format(self.iter, len(self.image_paths), scanning, self.get_path()) 
 
     def is_video_mode(self): 
         try: return self._video_mode
         except: return False 
 
+    def wait_for_scan(self): 
+        # Block until the directory scan is finished, returns the number of images. 
+        if not self.is_video_mode() and self.scanner is not None: self.scanner.join() 
+        return len(self.image_paths) 
+
     def get_orig_img(self): 
         if self._video_mode: 
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.iter*self.interval) 
-            _, img = self.cap.read() 
-            return img 
+            return self.video.read(self.image_paths.frame(self.iter)) 
         else: return cv2.imread(self.image_paths[self.iter]) 
 
     def get_frame(self, i): 
-        backup_i = self.cap.get(cv2.CAP_PROP_POS_FRAMES) 
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, i*self.interval) 
-        _, img = self.cap.read() 
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, backup_i) 
-        return img 
+        return self.video.read(self.image_paths.frame(i)) 
+
+    def get_video_frame(self, frame): 
+        # By frame number, regardless of the frame interval. 
+        return self.video.read(frame) 
 
     def set_frame_interval(self, interval): 
         # For video mode only. 
         self.interval = interval 
-        self.image_paths = [path for i, path in enumerate(self.image_paths) if i % self.interval == 0] 
+        self.image_paths = FrameList(self.image_paths.video_path, range(0, self.video.length, self.interval)) 
         print(f"{len(self.image_paths)} frames left.") 
 
+    def _resize(self, img): 
+        # Resize if oversized. 
+        if img.shape[0] >= self.interface._winsize or img.shape[1] >= self.interface._winsize: 
+            ratio = self.interface._winsize / max(img.shape) 
+            img = cv2.resize(img, (int(img.shape[1]*ratio), int(img.shape[0]*ratio))) 
+        return img 
+
+    def _read_resized(self, path): 
+        return self._resize(cv2.imread(path)) 
+
+    def _prefetch(self): 
+        # Decode the images around iter on the cache worker threads. 
+        ahead = range(self.iter, min(self.iter + self.prefetch_ahead, len(self.image_paths))) 
+        behind = range(max(self.iter - 1 - self.prefetch_behind, 0), self.iter - 1) 
+        self.cache.prefetch([str(self.image_paths[i]) for i in list(ahead) + list(reversed(behind))]) 
+
     def next(self, save_checkpoint=False): 
-        global endFlag
+        global endFlag, __scheduler__ 
+        if not self._video_mode: self.scanner.wait_for(self.iter + 1) 
         if self.iter >= len(self.image_paths): 
             print("No more image to process.") 
             return None 
         # Read image data. 
         if not self._video_mode: 
-            self.img = cv2.imread(str(self.image_paths[self.iter])) 
+            self.img = self.cache.get(str(self.image_paths[self.iter])) 
+            # Update iter count.  
+            self.iter += 1 
+            self._prefetch() 
         else: 
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.iter*self.interval)
-            _, self.img = self.cap.read() 
-        # Update iter count.  
-        self.iter += 1 
-        # Resize if oversized. 
-        if self.img.shape[0] >= self.interface._winsize or self.img.shape[1] >= self.interface._winsize: 
-            ratio = self.interface._winsize / max(self.img.shape) 
-            self.img = cv2.resize(self.img, (int(self.img.shape[1]*ratio), int(self.img.shape[0]*ratio))) 
+            self.img = self.video.read(self.image_paths.frame(self.iter)) 
+            # Update iter count.  
+            self.iter += 1 
+            self.img = self._resize(self.img) 
+        __scheduler__.invalidate() 
         # Save checkpoint if needed. 
         if save_checkpoint and not self._video_mode: 
             try: os.remove(os.path.join(str(self.path), "_iter.txt")) 
@@ -547,6 +777,7 @@ class ImageHandler:
 
     def delete(self): 
         try: 
+            self.cache.discard(str(self.image_paths[self.iter - 1])) 
             os.remove(self.image_paths[self.iter - 1]) 
             self.deleted += 1 
         except Exception as e: print(e) 
@@ -557,20 +788,30 @@ class ImageHandler:
             except: pass 
             with open(os.path.join(str(self.path), "_iter.txt"), "w") as f: 
                 f.write(str(0)) 
-        else: self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0) 
         self.iter = 0 
 
+    def close(self): 
+        if self.scanner is not None: self.scanner.stop() 
+        if self.video is not None: self.video.close() 
+        print(self.cache.get_formatted_info()) 
+        self.cache.close() 
+
     def remove_similar_images(self): 
         toolThread = Thread("toolThread", self._remove_similar_images_thr) 
         toolThread.start() 
     
     def _remove_similar_images_thr(self, nothing): 
+        self.wait_for_scan()   # The progress is over the whole directory. 
         tool = rm_sim_imgs.Tool(self.image_paths, self.interface, 10)
         tool.run() 
 
 class Interface: 
-    def __init__(self, refresh_rate=80): 
+    def __init__(self, refresh_rate=80, max_fps=30, idle_fps=1): 
+        global __scheduler__ 
         self.refresh_rate = refresh_rate 
+        self.scheduler = __scheduler__ 
+        self.scheduler.max_fps = max_fps 
+        self.scheduler.idle_fps = idle_fps 
         self._winsize = 900 
         cv2.namedWindow("Crop Image", cv2.WINDOW_NORMAL) 
         cv2.resizeWindow("Crop Image", self._winsize, self._winsize) 
@@ -587,6 +828,7 @@ class Interface:
         self.menuTree.addParent("Edit") 
         self.menuTree.addChild("Edit", "Reset checkpoint", onClick=self.reset_checkpoint) 
         self.menuTree.addChild("Edit", "Set frame interval (video)", onClick=self._set_frame_interval_thr)
+        self.menuTree.addChild("Edit", "Load saved bndboxes", onClick=self.crop_tool.load_saved_bndboxes) 
         self.menuTree.addParent("Tool") 
         self.menuTree.addChild("Tool", "Remove similar images", onClick=self.image_handler.remove_similar_images)
         self.buttons = list() 
@@ -597,10 +839,21 @@ class Interface:
         self.buttons.append(Button((390,40), 50, 30, "Next", self.mouseHandler, onClick=self.next)) 
         self.buttons.append(Button((450,40), 120, 30, "Crop & Next", self.mouseHandler, onClick=self.next, args=True)) 
         self.notifier = Notifier() 
+        self.compositor = Compositor(self._winsize) 
         self.notifier.new_notifier((590,10), 300, 100, "Notification", "Press ESC or File > Exit to exit.")
         self.pluginManager = Plugins(self, self.image_handler, self.crop_tool) 
         self.dir_path = None 
 
+    @property 
+    def dialog(self): 
+        return self._dialog 
+
+    @dialog.setter 
+    def dialog(self, dialog): 
+        # Dialogs are opened and closed from worker threads, redraw on change. 
+        self._dialog = dialog 
+        self.scheduler.invalidate() 
+
     def _load_plugin_thr(self, pluginName): 
         loadThread = Thread("loadThread", self._load_plugin, args=pluginName)
         loadThread.start() 
@@ -719,49 +972,49 @@ class Interface:
             s = " " * (10 - len(s)) + s 
             return s
 
-        # Show curent frame. 
-        mat = np.ones((self._winsize,self._winsize,3), dtype=np.uint8) * 27 
-        try:  
-            pt1 = (int((self._winsize-self.img.shape[1])/2), int((self._winsize-self.img.shape[0])/2)) 
-            pt2 = (pt1[0] + self.img.shape[1], pt1[1] + self.img.shape[0])
-            mat[pt1[1]:pt2[1], pt1[0]:pt2[0]] = self.image_handler.img 
-        except: pass  
-
-        # Show cursor coordinate and image path info. 
+        # Show curent frame and image path info, cached in the base layer. 
         try: 
-            cv2.putText(mat, _format_coor(), (self._winsize-90, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (100,100,100), 1) 
-            cv2.putText(mat, self.image_handler.get_formatted_info(), (3, self._winsize-10), 
+            pt1 = (int((self._winsize-self.img.shape[1])/2), int((self._winsize-self.img.shape[0])/2)) 
+            img = self.img 
+        except: pt1 = None; img = None 
+        try: info = self.image_handler.get_formatted_info() 
+        except: info = None 
+        self.compositor.update_base(img, pt1, info) 
+        mat = self.compositor.compose() 
+
+        # Show cursor coordinate. 
+        cv2.putText(mat, _format_coor(), (self._winsize-90, 50), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (100,100,100), 1) 
+
+        # Show crop writer queue. 
+        if self.crop_tool.writer.writes > 0 or self.crop_tool.writer.depth() > 0: 
+            cv2.putText(mat, self.crop_tool.writer.get_formatted_info(), (self._winsize-330, self._winsize-50), 
                         cv2.FONT_HERSHEY_SIMPLEX, 0.5, (100,100,100), 1) 
-        except: pass 
 
         # Show crop box. 
         try: 
             self.crop_tool.show_crop_box(mat, pt1, self.mouseHandler.x, self.mouseHandler.y, self.mouseHandler.click)
         except: pass 
 
-        # Show buttons. 
+        # Update buttons, menuTree and notifier. 
         try: 
-            for button in self.buttons: 
-                button.update_status()
-                button.construct_button(mat) 
+            for button in self.buttons: button.update_status()
         except: pass 
-
-        # Show menuTree. 
-        try: 
-            self.menuTree.update_status() 
-            self.menuTree.construct_menu_tree(mat) 
+        try: self.menuTree.update_status() 
+        except: pass 
+        try: self.notifier.update_status(self.mouseHandler.x, self.mouseHandler.y, self.mouseHandler.click)
         except: pass 
 
+        # Show buttons, menuTree and notifier from the chrome layer. 
+        widgets = [((button.text, button.status), button.pt1, button.pt2, button.construct_button) 
+                   for button in self.buttons] 
+        widgets += self.menuTree.widgets() + self.notifier.widgets() 
+        self.compositor.update_chrome(widgets) 
+        self.compositor.blit_chrome() 
+
         # Update crop box. 
         try: self.crop_tool.action(mat, pt1, self.mouseHandler.x, self.mouseHandler.y, self.mouseHandler.click) 
         except: pass 
 
-        # Show notifier. 
-        try: 
-            self.notifier.update_status(self.mouseHandler.x, self.mouseHandler.y, self.mouseHandler.click)
-            self.notifier.construct_notifiers(mat)
-        except: pass 
-
         # Show dialog. 
         try: 
             self.dialog.update_status() 
@@ -811,12 +1064,21 @@ class Interface:
     def refresh(self, nothing): 
         global endFlag
         while not endFlag: 
-            cv2.imshow("Crop Image", self._win_img()) 
+            # Keep animating the "Please wait." progress bar. 
+            try: 
+                if self.dialog.dialog_type == Dialog.PROGRESS: self.scheduler.invalidate() 
+            except: pass 
+            if self.scheduler.wait_frame(): 
+                cv2.imshow("Crop Image", self._win_img()) 
 
     def close(self): 
         global endFlag 
         print("Closing.")
+        print(self.scheduler.get_formatted_info()) 
         endFlag = True 
+        self.scheduler.invalidate() 
+        self.image_handler.close() 
+        self.crop_tool.close() 
         self.pluginManager.close() 
         cv2.destroyAllWindows() 
         cv2.waitKey(1000)
@@ -827,7 +1089,7 @@ class Crop_Tool:
     def __init__(self, interface, imageHandler):
         self.prev_bnd = None 
         self.bnd = None 
-        self.bndboxes = dict() 
+        self.bndboxes = BoxStore() 
         self.points = None 
         self.status = -1 
         self.width = None
@@ -837,29 +1099,55 @@ class Crop_Tool:
         self.imageHandler = imageHandler 
         self.padding_left = self.padding_right = 0 
         self.padding_top = self.padding_bottom = 0 
+        self.output_mode = "files" 
+        self.sink = make_sink(self.output_mode) 
+        self.writer = CropWriter(on_change=self.interface.scheduler.invalidate, 
+                                 write_func=lambda path, img: self.sink.write(path, img)) 
 
-    def feed_bndboxes(self, bndboxes): 
+    def feed_bndboxes(self, bndboxes, paths=None): 
         '''
         Feed in bndbox data. 
 
         Arguments: 
         ------------
-            bndboxes: dict 
+            bndboxes: dict or ResultStore 
                 Dictionary contains bndbox data corresponds to each image path. 
                 See format below. 
+            paths: list 
+                Paths to look up in bndboxes, all of its paths if None. 
         ------------
         Please make sure format as following: \n
         {"IMAGE_PATH_1": {"score": "CONFIDENCE (OPTIONAL)", "bbox": [X1, Y1, X2, Y2] } } \n
         X1...Y2 should be in decimal ratio by image shape. E.g.: ∈ [0., 1.]
 
         '''
-        for i in bndboxes: 
-            if i not in self.bndboxes and len(bndboxes[i]) > 0: 
-                self.bndboxes[i] = bndboxes[i] 
-        print("Fed", len(bndboxes), "bndboxes.") 
+        print("Fed", self.bndboxes.feed(bndboxes, paths), "bndboxes.") 
         if self.path in self.bndboxes: 
             self._apply_bndbox()
         else: print("Not in data.", self.path) 
+        self.interface.scheduler.invalidate() 
+
+    def load_saved_bndboxes(self): 
+        # Results saved next to the images by the plugins or batch_crop.py, one store per directory. 
+        if self.imageHandler.image_paths is None: return 
+        if self.imageHandler.is_video_mode(): 
+            # One store next to the video, filtered by frame number, no string per frame. 
+            frames = self.imageHandler.image_paths 
+            dir_path = os.path.split(frames.video_path)[0] 
+            if not ResultStore.exists(dir_path): return 
+            store = ResultStore(dir_path) 
+            try: self.feed_bndboxes(store, (path for path in store if path in frames)) 
+            finally: store.close(compact=False) 
+            return 
+        paths = dict() 
+        for path in self.imageHandler.image_paths: 
+            path = str(path) 
+            paths.setdefault(os.path.split(path)[0], list()).append(path) 
+        for dir_path in paths: 
+            if not ResultStore.exists(dir_path): continue 
+            store = ResultStore(dir_path) 
+            try: self.feed_bndboxes(store, paths[dir_path]) 
+            finally: store.close(compact=False)  # A plugin may hold the same file open. 
 
     def _bnd_8_points(self): 
         self.points = list() 
@@ -883,11 +1171,9 @@ class Crop_Tool:
         except Exception as e: print(e)
     
     def _draw_fed_bndboxes(self, mat, padding): 
-        for bnd in self.bndboxes[self.path]: 
-            bnd = bnd["bbox"] 
-            cv2.rectangle(mat, (padding[0]+int(bnd[0]*self.width), padding[1]+int(bnd[1]*self.height)), 
-                          (padding[0]+int(bnd[2]*self.width), padding[1]+int(bnd[3]*self.height)), 
-                          (150,150,150), 2) 
+        bnds = (self.bndboxes.get(self.path) * [self.width, self.height, self.width, self.height]).astype(int) 
+        for bnd in (bnds + [padding[0], padding[1], padding[0], padding[1]]).tolist(): 
+            cv2.rectangle(mat, (bnd[0], bnd[1]), (bnd[2], bnd[3]), (150,150,150), 2) 
 
     def _draw_8_points(self, mat, padding, x, y, click): 
         self._bnd_8_points() 
@@ -903,12 +1189,13 @@ class Crop_Tool:
             cv2.circle(mat, (padding[0]+pt[0], padding[1]+pt[1]), 7, color, 2) 
 
     def _bnd_padding(self): 
-        box_w = self.bndboxes[self.path][0]["bbox"][2] - self.bndboxes[self.path][0]["bbox"][0] 
-        box_h = self.bndboxes[self.path][0]["bbox"][3] - self.bndboxes[self.path][0]["bbox"][1] 
-        self.padding_left = (self.bnd[0] / self.width - self.bndboxes[self.path][0]["bbox"][0]) / box_w
-        self.padding_right = (self.bnd[2] / self.width - self.bndboxes[self.path][0]["bbox"][2]) / box_w 
-        self.padding_top = (self.bnd[1] / self.height - self.bndboxes[self.path][0]["bbox"][1]) / box_h 
-        self.padding_bottom = (self.bnd[3] / self.height - self.bndboxes[self.path][0]["bbox"][3]) / box_h 
+        bbox = self.bndboxes.get(self.path)[0].tolist() 
+        box_w = bbox[2] - bbox[0] 
+        box_h = bbox[3] - bbox[1] 
+        self.padding_left = (self.bnd[0] / self.width - bbox[0]) / box_w
+        self.padding_right = (self.bnd[2] / self.width - bbox[2]) / box_w 
+        self.padding_top = (self.bnd[1] / self.height - bbox[1]) / box_h 
+        self.padding_bottom = (self.bnd[3] / self.height - bbox[3]) / box_h 
 
     def _limit_action(self): 
         if not self.status == 8: 
@@ -999,15 +1286,11 @@ class Crop_Tool:
         self.bnd[2] = int(self.prev_bnd[2] / self.width * img.shape[1])
         self.bnd[3] = int(self.prev_bnd[3] / self.height * img.shape[0]) 
 
+    def get_padding(self): 
+        return (self.padding_left, self.padding_top, self.padding_right, self.padding_bottom) 
+
     def _apply_bndbox(self, idx=0): 
-        bnd = self.bndboxes[self.path][idx]["bbox"] 
-        box_w = bnd[2] - bnd[0]; box_h = bnd[3] - bnd[1] 
-        self.bnd[0] = int((bnd[0] + self.padding_left * box_w) * self.width)
-        self.bnd[1] = int((bnd[1] + self.padding_top * box_h) * self.height)
-        self.bnd[2] = int((bnd[2] + self.padding_right * box_w) * self.width) 
-        self.bnd[3] = int((bnd[3] + self.padding_bottom * box_h) * self.height) 
-        self.status = 9  
-        self._limit_action()
+        self.bnd[:] = padded_box(self.bndboxes.get(self.path)[idx], self.get_padding(), self.width, self.height) 
         self.status = -1 
     
     def new_crop(self, img, img_path): 
@@ -1027,7 +1310,8 @@ class Crop_Tool:
         y1 = int(self.bnd[1] / self.height * img.shape[0])
         x2 = int(self.bnd[2] / self.width * img.shape[1])
         y2 = int(self.bnd[3] / self.height * img.shape[0]) 
-        cv2.imwrite(img_path+".jpg", img[min(y1,y2):max(y2,y1), min(x1,x2):max(x2,x1)]) 
+        # Copy the crop, the writer thread may run after img is replaced. 
+        self.writer.write(img_path+".jpg", img[min(y1,y2):max(y2,y1), min(x1,x2):max(x2,x1)].copy()) 
 
     def crop_all_bndboxes(self): 
         processThread = Thread("processThread", self._crop_all_bndboxes_thr) 
@@ -1035,39 +1319,41 @@ class Crop_Tool:
 
     def _crop_all_bndboxes_thr(self, nothing): 
         global endFlag 
+        self.load_saved_bndboxes() 
         if len(self.bndboxes) < 1: 
             self.interface._info_dialog("Error: No bndboxes.") 
             return 
         self.interface._progress_dialog("Cropping images.")
-        backup_path = self.path 
-        backup_width = self.width 
-        backup_height = self.height
-        backup_iter = self.imageHandler.iter 
-        for idx, path in enumerate(self.bndboxes): 
-            if endFlag: break 
-            try: 
-                self.imageHandler.iter = int(int(path.split("-")[-1]) / self.imageHandler.interval)   
-                self.path = path 
-                self.interface.dialog.progressbar.update_progressbar((idx+1)/(len(self.bndboxes))) 
-                output_dir = os.path.join(os.path.split(path)[0], "Output")  
-                if not os.path.exists(output_dir): os.makedirs(output_dir) 
-                if not self.imageHandler.is_video_mode(): img = cv2.imread(path) 
-                else: img = self.imageHandler.get_frame(self.imageHandler.iter) 
-                self.width = img.shape[1] 
-                self.height = img.shape[0] 
-                for i, bnd in enumerate(self.bndboxes[path]): 
-                    self._apply_bndbox(idx=i) 
-                    im_path = os.path.join(output_dir, os.path.split(path)[-1].replace(".jpg", "")
-                                            .replace(".png", "")+"-"+str(i)+".jpg") 
-                    cv2.imwrite(im_path, img[self.bnd[1]:self.bnd[3], self.bnd[0]:self.bnd[2]]) 
-            except Exception as e: print(e) 
-        self.path = backup_path 
-        self.width = backup_width 
-        self.height = backup_height 
-        self.imageHandler.iter = backup_iter 
-        self._apply_bndbox() 
+        progressbar = self.interface.dialog.progressbar 
+        # Crops already written by a previous (interrupted) run are skipped. 
+        root = str(self.imageHandler.path) 
+        if self.imageHandler.is_video_mode(): root = os.path.split(root)[0] 
+        manifest = CropManifest(os.path.join(root, "Output", "_manifest.jsonl"), self.sink.settings) 
+        engine = CropEngine(self.get_padding(), write=self.sink.write, 
+                            progress=lambda done, total: progressbar.update_progressbar(done/total), 
+                            stop=lambda: endFlag, manifest=manifest, saved=self.sink.on_saved) 
+        if not self.imageHandler.is_video_mode(): engine.run(self.bndboxes) 
+        else: 
+            # Decode the video once in frame order, with its own decoder. 
+            frames = self.imageHandler.image_paths 
+            engine.run_video(self.bndboxes, frames.video_path, frames.frame_of) 
+        self.sink.close()  # Finish the open shards, which records their images. 
+        manifest.close() 
+        print(f"{engine.written} crops written, {engine.skipped} images skipped, {engine.failed} images failed.") 
         self.interface._info_dialog("Process completed.") 
 
+    def set_output_mode(self, mode): 
+        # "files", "tar" or "npy", see Tools/shard_writer.py. 
+        self.writer.flush() 
+        self.sink.close() 
+        self.output_mode = mode 
+        self.sink = make_sink(mode) 
+        print("Output mode:", mode) 
+
+    def close(self): 
+        self.writer.close() 
+        self.sink.close() 
+
 
 class Plugins: 
     
@@ -1096,6 +1382,13 @@ class Plugins:
         processThread = Thread("processThread", self._plugin_func_thr, func) 
         processThread.start() 
     
+    def _plugin_option(self, option): 
+        processThread = Thread("processThread", self._plugin_option_thr, option) 
+        processThread.start() 
+
+    def _plugin_option_thr(self, option): 
+        option["func"](option["args"]) 
+
     def _plugin_func_thr(self, func): 
         value = func["func"](func["args"]) 
         self.interface.crop_tool.feed_bndboxes(value)
@@ -1136,6 +1429,10 @@ class Plugins:
         for func in plugin.funcs: 
             self.interface.menuTree.addChild(plugin.name, func["name"], onClick=self._plugin_func, 
                                                 args=func)
+        # Options change plugin settings, their return value is not fed to the crop tool. 
+        for option in getattr(plugin, "options", list()): 
+            self.interface.menuTree.addChild(plugin.name, option["name"], onClick=self._plugin_option, 
+                                                args=option)
         if status: 
             if len(self.active) == 1: self._add_output_functions()
             return True 
@@ -1145,22 +1442,29 @@ class Plugins:
         if not self.interface.menuTree.exists("Output"): 
             self.interface.menuTree.addParent("Output") 
             self.interface.menuTree.addChild("Output", "Crop all bndboxes", onClick=self.crop_tool.crop_all_bndboxes) 
+            self.interface.menuTree.addChild("Output", "Write crops as files", onClick=self.crop_tool.set_output_mode, 
+                                             args="files") 
+            self.interface.menuTree.addChild("Output", "Write crops as tar shards", 
+                                             onClick=self.crop_tool.set_output_mode, args="tar") 
+            self.interface.menuTree.addChild("Output", "Write crops as npy shards", 
+                                             onClick=self.crop_tool.set_output_mode, args="npy") 
     
     def close(self): 
         for plugin in self.active: 
             plugin.close()  
 
 
-win = Interface() 
-refreshThread = Thread("refreshThread", win.refresh) 
-refreshThread.start() 
-# loadThread = Thread("loadThread", win.load_images, "F:/Datasets/VNDB_characters_image") # MAL_characters_image") 
-# loadThread.start() 
-keyHandler = KeyHandler() 
-keyHandler.add_action(27, win.close) 
-keyHandler.add_action(13, win.next, True) 
-keyHandler.add_action(46, win.zoom_in) 
-keyHandler.add_action(44, win.zoom_out) 
-keyHandler.add_action(120, win.delete)  
-keyHandler.add_action(114, win.reset) 
-while not endFlag: keyHandler.handle_key(win.refresh_rate)
+if __name__ == "__main__": 
+    win = Interface() 
+    refreshThread = Thread("refreshThread", win.refresh) 
+    refreshThread.start() 
+    # loadThread = Thread("loadThread", win.load_images, "F:/Datasets/VNDB_characters_image") # MAL_characters_image") 
+    # loadThread.start() 
+    keyHandler = KeyHandler() 
+    keyHandler.add_action(27, win.close) 
+    keyHandler.add_action(13, win.next, True) 
+    keyHandler.add_action(46, win.zoom_in) 
+    keyHandler.add_action(44, win.zoom_out) 
+    keyHandler.add_action(120, win.delete)  
+    keyHandler.add_action(114, win.reset) 
+    while not endFlag: keyHandler.handle_key(win.refresh_rate)
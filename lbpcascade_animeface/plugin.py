@@ -2,31 +2,59 @@ import os
 import cv2
 import json
 import time
+import threading
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from Tools.result_store import ResultIndex
+from Tools.image_probe import image_size
 
 endFlag = False 
 
+# Detection sizes of the plugin menu, None for full resolution (the default). 
+MAX_SIDES = (None, 2048, 1600, 1024, 768) 
+
+# Decode flags by reduction factor, largest first. 
+REDUCED_GRAYSCALE = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4), 
+                     (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)) 
+
 class Plugin: 
     '''
     Plugin initializations. 
     '''
 
-    def __init__(self, interface, image_handler): 
-        self.result = dict() 
+    def __init__(self, interface, image_handler, workers=None, max_side=None): 
+        self.results = ResultIndex()   # Saved results, by directory. 
         self.interface = interface 
         self.image_handler = image_handler 
+        self.workers = workers or os.cpu_count() or 1 
+        # Longest image side detection runs at, None for full resolution. 
+        # minSize stays in detection pixels, so smaller faces are missed at lower sizes. 
+        self.max_side = max_side 
+        self.progress_interval = 0.1   # Seconds between progressbar updates. 
+        self._local = threading.local() 
 
         # Specify plugin functions availabled. 
         self.funcs = [{"name": "Detect face", "func": self.predict, "args": None}, 
                       {"name": "All faces", "func": self.predict, "args": self.image_handler.image_paths}] 
+        # Settings, listed in the plugin menu. 
+        # Smaller sizes are faster and may miss small faces, measure them with resolution_report.py. 
+        self.options = [{"name": "Detection size: " + (str(size) if size else "full"), "func": self.set_max_side, 
+                         "args": size} for size in MAX_SIDES] 
 
     def load(self, base): 
         try: 
-            path = os.path.join(base, "lbpcascade_animeface", "Cascade", "lbpcascade_animeface.xml")
-            self.cascade = cv2.CascadeClassifier(path) 
+            self.cascade_path = os.path.join(base, "lbpcascade_animeface", "Cascade", "lbpcascade_animeface.xml")
+            self.cascade = cv2.CascadeClassifier(self.cascade_path) 
+            self._local.cascade = self.cascade 
         except Exception as e: print("lbpcascade_animeface:", e); return False 
         return True 
 
+    def set_max_side(self, max_side): 
+        # Applies to the next detection, results already stored are kept. 
+        self.max_side = max_side 
+        print("lbpcascade_animeface: detection size", max_side or "full") 
+
     
     '''
     Plugin destructions 
@@ -35,6 +63,7 @@ class Plugin:
     def close(self): 
         global endFlag 
         endFlag = True 
+        self.results.close() 
         print("Plugin closed.") 
 
 
@@ -43,26 +72,114 @@ class Plugin:
     '''
 
     def dump_result(self, result): 
-        for name in result: self.result[name] = result[name] 
-        self.save_json() 
+        # Appends each image's boxes to the result store. 
+        self.results.update(result) 
+
+    def _read(self, path): 
+        # Decode in grayscale, reduced by the largest power of two that keeps max_side. 
+        if self.max_side is not None: 
+            size = image_size(path) 
+            if size is not None: 
+                for factor, flag in REDUCED_GRAYSCALE: 
+                    if max(size) / factor >= self.max_side: return cv2.imread(path, flag) 
+        return cv2.imread(path, cv2.IMREAD_GRAYSCALE) 
+
+    def _limit_size(self, img): 
+        # Downscale so the longest side is at most max_side. 
+        if self.max_side is None or max(img.shape[:2]) <= self.max_side: return img 
+        ratio = self.max_side / max(img.shape[:2]) 
+        return cv2.resize(img, (max(int(img.shape[1]*ratio), 1), max(int(img.shape[0]*ratio), 1)), 
+                          interpolation=cv2.INTER_AREA) 
+
+    def detect_image(self, img): 
+        # Detect faces in one image, returns normalized square bboxes. 
+        # Bboxes are normalized by the detection size, so they apply to the original image. 
+        if img.ndim == 3: img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) 
+        img = self._limit_size(img) 
+        faces = self._cascade().detectMultiScale(img,
+                             # detector options
+                             scaleFactor = 1.1,
+                             minNeighbors = 5,
+                             minSize = (24, 24))
+        result = list() 
+        for (x1, y1, w, h) in faces: 
+            x2 = x1 + w; y2 = y1 + h
+            cx = (x2 + x1) / 2; cy = (y2 + y1) / 2 
+            s = min(w,h) / 2
+            x1 = (cx-s) / img.shape[1]; x2 = (cx+s) / img.shape[1] 
+            y1 = (cy-s) / img.shape[0]; y2 = (cy+s) / img.shape[0]
+            result.append({"bbox": [x1,y1,x2,y2]}) 
+        return result 
 
-    def save_json(self): 
-        if len(self.result) < 1: return 
-        try: 
-            fname = os.path.join(os.path.split([name for name in self.result][0])[0], "output.json")
-            with open(fname, "w") as f: json.dump(self.result, f) 
-        except: pass 
+    def _cascade(self): 
+        # CascadeClassifier is not thread safe, one per worker thread. 
+        cascade = getattr(self._local, "cascade", None) 
+        if cascade is None: cascade = self._local.cascade = cv2.CascadeClassifier(self.cascade_path) 
+        return cascade 
+
+    def _detect_path(self, path): 
+        # Returns (bboxes, is_new_result). 
+        r = self.try_get_from_json(path) 
+        if r is not None: return r, False 
+        img = self._read(path) 
+        if img is None: raise IOError("Cannot read " + path) 
+        return self.detect_image(img), True 
+
+    def _cached(self, r): 
+        return r, False 
+
+    def _detect_frame(self, img): 
+        if img is None: raise IOError("Cannot read frame") 
+        return self.detect_image(img), True 
+
+    def _run_jobs(self, jobs, total): 
+        '''
+        Run detection jobs on the worker pool, results are collected in path order. 
+
+        Arguments: 
+        ------------
+            jobs: iterable 
+                (path, func, args) where func(*args) returns (bboxes, is_new_result). 
+            total: int 
+                Number of jobs, for the progressbar. 
+        ------------
+
+        '''
+        global endFlag 
+        result = dict() 
+        window = self.workers * 4   # Bound the images in flight. 
+        done = 0 
+        last_update = 0 
+        with ThreadPoolExecutor(max_workers=self.workers) as pool: 
+            futures = deque() 
+            def collect(): 
+                nonlocal done, last_update 
+                path, future = futures.popleft() 
+                try: 
+                    r, new = future.result() 
+                    result[path] = r 
+                    #   New results are appended to the result store. 
+                    if new: self.dump_result({path: r}) 
+                except Exception as e: print(str(e), path) 
+                done += 1 
+                #   Update progressbar progress, at most every progress_interval. 
+                if time.time() - last_update >= self.progress_interval: 
+                    self.interface.dialog.progressbar.update_progressbar(done/total) 
+                    last_update = time.time() 
+            for path, func, args in jobs: 
+                if endFlag: break 
+                futures.append((path, pool.submit(func, *args))) 
+                if len(futures) >= window: collect() 
+            while futures: collect() 
+
+        # Update progressbar progress to 1. 
+        self.interface.dialog.progressbar.update_progressbar(1.)
+        return result 
 
     def try_get_from_json(self, path): 
-        if path not in self.result: 
-            try: 
-                fname = os.path.join(os.path.split(path)[0], "output.json")
-                with open(fname, "r") as f: self.result = json.load(f) 
-            except: pass 
-        if path in self.result: 
-            print("From cache.")
-            return self.result[path] 
-        else: return None 
+        r = self.results.get(path) 
+        if r is not None: print("From cache.") 
+        return r 
 
     
     ''' 
@@ -82,56 +199,17 @@ class Plugin:
         if paths is None: 
             #   Force it to be a list. 
             paths = [self.image_handler.get_path()] 
-
-        #   Number of paths. 
-        file_len = len(paths)
-        result = dict() 
+        #   Else all faces: the whole directory once scanned, the list of funcs may be older. 
+        else: 
+            self.image_handler.wait_for_scan() 
+            paths = self.image_handler.image_paths 
 
         #   Create a progress dialog in Interface. 
         self.interface._progress_dialog("Finding face") 
 
-        #   For each path: 
-        for idx, path in enumerate(paths): 
-            global endFlag
-            if endFlag: break 
-            try: 
-                path = str(path) 
-                
-                #   Try to get result from saved json. 
-                r = self.try_get_from_json(path)
-                if r is not None: 
-                    result[path] = r
-                    continue  
-                
-                #   Not in json: 
-                #       Read image and detect. 
-                img = cv2.imread(path, 0)  
-                faces = self.cascade.detectMultiScale(img,
-                                     # detector options
-                                     scaleFactor = 1.1,
-                                     minNeighbors = 5,
-                                     minSize = (24, 24))
-
-                result[path] = list() 
-                for (x1, y1, w, h) in faces: 
-                    x2 = x1 + w; y2 = y1 + h
-                    cx = (x2 + x1) / 2; cy = (y2 + y1) / 2 
-                    s = min(w,h) / 2
-                    x1 = (cx-s) / img.shape[1]; x2 = (cx+s) / img.shape[1] 
-                    y1 = (cy-s) / img.shape[0]; y2 = (cy+s) / img.shape[0]
-                    new_result = {"bbox": [x1,y1,x2,y2]}
-                    result[path].append(new_result) 
-
-                #   Update progressbar progress. 
-                self.interface.dialog.progressbar.update_progressbar((idx+1)/(len(paths))) 
-
-            except Exception as e: 
-                print(str(e)) 
-
-        # Update progressbar progress to 1. 
-        self.interface.dialog.progressbar.update_progressbar(1.)
-        self.dump_result(result) 
-        return result 
+        #   Read and detect each image on the pool. 
+        jobs = ((str(path), self._detect_path, (str(path),)) for path in paths) 
+        return self._run_jobs(jobs, len(paths)) 
 
 
     # Minor edit for video mode. 
@@ -139,50 +217,15 @@ class Plugin:
         # Whole video: 
         if all_frames: paths = self.image_handler.image_paths 
         # Or current frame: 
-        else: paths = [self.image_handler.get_path()] 
+        else: paths = self.image_handler.image_paths[self.image_handler.iter-1:self.image_handler.iter] 
         
-        file_len = len(paths)
-        result = dict() 
         self.interface._progress_dialog("Finding face") 
 
-        for idx, path in enumerate(paths): 
-            if not all_frames: idx = self.image_handler.iter
-            global endFlag
-            if endFlag: break 
-            try: 
+        #   Frames are decoded in order on this thread, only detection runs on the pool. 
+        def jobs(): 
+            for idx, path in enumerate(paths): 
                 path = str(path) 
-                
-                r = self.try_get_from_json(path)
-                if r is not None: 
-                    result[path] = r
-                    continue  
-                
-                img = self.image_handler.get_frame(idx) 
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) 
-
-                faces = self.cascade.detectMultiScale(img,
-                                     # detector options
-                                     scaleFactor = 1.1,
-                                     minNeighbors = 5,
-                                     minSize = (24, 24))
-
-                result[path] = list()
-                for (x1, y1, w, h) in faces: 
-                    x2 = x1 + w; y2 = y1 + h
-                    cx = (x2 + x1) / 2; cy = (y2 + y1) / 2 
-                    s = min(w,h) / 2
-                    x1 = (cx-s) / img.shape[1]; x2 = (cx+s) / img.shape[1] 
-                    y1 = (cy-s) / img.shape[0]; y2 = (cy+s) / img.shape[0]
-                    new_result = {"bbox": [x1,y1,x2,y2]}
-                    result[path].append(new_result) 
-
-                #   Update progressbar progress. 
-                self.interface.dialog.progressbar.update_progressbar((idx+1)/(len(paths))) 
-
-            except Exception as e: 
-                print(str(e)) 
-
-        # Update progressbar progress to 1. 
-        self.interface.dialog.progressbar.update_progressbar(1.)
-        self.dump_result(result) 
-        return result 
+                r = self.try_get_from_json(path) 
+                if r is not None: yield path, self._cached, (r,) 
+                else: yield path, self._detect_frame, (self.image_handler.get_video_frame(paths.frame(idx)),) 
+        return self._run_jobs(jobs(), len(paths)) 
@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lbpcascade_animeface.plugin import Plugin
+from Tools.directory_scanner import DirectoryScanner
+
+'''
+Speed versus recall of lbpcascade_animeface at several detection sizes.
+Full resolution detections are the reference. For each max side, reports
+the decode + detect time per image, and the recall / precision of its
+boxes against the reference (matched at IoU >= -iou).
+
+    python lbpcascade_animeface/resolution_report.py -i /path/to/samples -sizes 1600 1024 768 512
+
+'''
+
+
+class _NoImageHandler:
+    image_paths = None
+
+
+def iou(a, b):
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0: return 0.
+    inter = w * h
+    return inter / ((a[2]-a[0]) * (a[3]-a[1]) + (b[2]-b[0]) * (b[3]-b[1]) - inter)
+
+
+def matches(ref, boxes, thresh):
+    # Greedy one to one matching, returns the number of matched pairs.
+    used = set()
+    n = 0
+    for r in ref:
+        best, best_iou = None, thresh
+        for j, b in enumerate(boxes):
+            if j in used: continue
+            v = iou(r["bbox"], b["bbox"])
+            if v >= best_iou: best, best_iou = j, v
+        if best is not None: used.add(best); n += 1
+    return n
+
+
+def run(plugin, files, max_side):
+    plugin.max_side = max_side
+    result = dict()
+    time_start = time.time()
+    for file in files:
+        img = plugin._read(file)
+        if img is None: continue
+        result[file] = plugin.detect_image(img)
+    return result, (time.time() - time_start) / max(len(files), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='lbpcascade_animeface detection size report')
+    parser.add_argument('-i', help='The input image directory', required=True, dest='input', type=str)
+    parser.add_argument('-sizes', help='Max sides to compare', nargs='+', dest='sizes', type=int,
+                        default=[1600, 1024, 768, 512])
+    parser.add_argument('-n', help='Number of sample images', dest='n', type=int, default=200)
+    parser.add_argument('-iou', help='IoU threshold of a match', dest='iou', type=float, default=0.5)
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.input), 'The input path is not a directory'
+    scanner = DirectoryScanner(args.input).start()
+    scanner.join()
+    files = [str(path) for path in scanner.paths]
+    if len(files) > args.n:
+        files = [files[i] for i in np.linspace(0, len(files) - 1, args.n).astype(int)]
+    print('%d sample images.' % len(files))
+
+    plugin = Plugin(None, _NoImageHandler())
+    assert plugin.load(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'Cannot load the cascade'
+
+    ref, ref_time = run(plugin, files, None)
+    ref_n = sum(len(boxes) for boxes in ref.values())
+    print('%-8s %10s %8s %8s %8s %8s' % ('max side', 'ms/image', 'speedup', 'faces', 'recall', 'precision'))
+    print('%-8s %10.1f %8.2f %8d %8.3f %8.3f' % ('full', ref_time * 1000, 1., ref_n, 1., 1.))
+    for size in args.sizes:
+        result, t = run(plugin, files, size)
+        n = sum(len(boxes) for boxes in result.values())
+        matched = sum(matches(ref[file], result.get(file, []), args.iou) for file in ref)
+        print('%-8d %10.1f %8.2f %8d %8.3f %8.3f' % (size, t * 1000, ref_time / t if t > 0 else 0, n,
+                                                    matched / ref_n if ref_n else 1., matched / n if n else 1.))
+    plugin.results.close()
+
+
+if __name__ == '__main__':
+    main()